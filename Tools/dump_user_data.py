@@ -4,47 +4,332 @@
 # Intended to service GDPR data requests or what have you.
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import io
+import json
 import os
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
 from uuid import UUID
 
 LATEST_DB_MIGRATION = "20230725193102_AdminNotesImprovementsForeignKeys"
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("output", help="Directory to output data dumps into.")
-    parser.add_argument("user", help="User name/ID to dump data into.")
+    parser.add_argument("users", nargs="*", metavar="user", help="User names/IDs to dump data of. With more than one, each gets a subdirectory of the output named after their ID.")
+    destination = parser.add_mutually_exclusive_group(required=True)
+    destination.add_argument("--output", "-o", help="Directory to output data dumps into.")
+    destination.add_argument("--archive", help="Write everything into this .zip or .tar.gz instead of a directory, with a SHA256SUMS manifest of its members.")
+    parser.add_argument("--users-file", help="File with more user names/IDs to dump, one per line.")
     parser.add_argument("--ignore-schema-mismatch", action="store_true")
     parser.add_argument("--connection-string", required=True, help="Database connection string to use. See https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-CONNSTRING")
+    parser.add_argument("--stream-admin-log", choices=["json", "ndjson"], help="Fetch admin_log through a server-side cursor and write it out as it arrives, as a JSON array or as newline-delimited JSON (admin_log.ndjson). Keeps memory flat for players with a lot of history.")
+    parser.add_argument("--itersize", type=int, default=2000, help="Rows fetched per round trip when streaming.")
+    parser.add_argument("--profile", metavar="REPORT", help="Write a JSON report of the time taken, rows dumped and bytes written for each table.")
+    parser.add_argument("--explain", action="store_true", help="With --profile, also run every query again under EXPLAIN (ANALYZE, BUFFERS) and flag sequential scans of large tables.")
+    parser.add_argument("--seq-scan-rows", type=int, default=10000, help="Sequential scans going through at least this many rows are flagged by --explain.")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="Number of tables to dump at once, each over its own connection. 1 dumps them one by one over a single connection.")
 
     args = parser.parse_args()
 
     arg_output: str = args.output
 
-    if not os.path.exists(arg_output):
+    names_or_uids = list(args.users)
+    if args.users_file:
+        with open(args.users_file, encoding="utf-8") as f:
+            names_or_uids += [line.strip() for line in f if line.strip()]
+    if not names_or_uids:
+        parser.error("no users given")
+    if args.archive and not args.archive.endswith((".zip", ".tar.gz", ".tgz")):
+        parser.error("--archive must end in .zip, .tar.gz or .tgz")
+
+    if args.explain and not args.profile:
+        parser.error("--explain needs --profile")
+
+    if arg_output and not os.path.exists(arg_output):
         print("Creating output directory (doesn't exist yet)")
         os.mkdir(arg_output)
 
     conn = psycopg2.connect(args.connection_string)
+    # Everything is read in one read-only snapshot, so the dumps agree with each other even if the server is live.
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
     cur = conn.cursor()
 
     check_schema_version(cur, args.ignore_schema_mismatch)
-    user_id = normalize_user_id(cur, args.user)
-
-    dump_admin(cur, user_id, arg_output)
-    dump_admin_log(cur, user_id, arg_output)
-    dump_admin_messages(cur, user_id, arg_output)
-    dump_admin_notes(cur, user_id, arg_output)
-    dump_admin_watchlists(cur, user_id, arg_output)
-    dump_connection_log(cur, user_id, arg_output)
-    dump_play_time(cur, user_id, arg_output)
-    dump_player(cur, user_id, arg_output)
-    dump_preference(cur, user_id, arg_output)
-    dump_server_ban(cur, user_id, arg_output)
-    dump_server_ban_exemption(cur, user_id, arg_output)
-    dump_server_role_ban(cur, user_id, arg_output)
-    dump_uploaded_resource_log(cur, user_id, arg_output)
-    dump_whitelist(cur, user_id, arg_output)
+    user_ids = normalize_user_ids(cur, names_or_uids)
+
+    # A single user is dumped straight into the output directory, like it always was.
+    if len(user_ids) == 1:
+        subdirs = {user_ids[0]: ""}
+    else:
+        subdirs = {user_id: user_id for user_id in user_ids}
+
+    if args.archive:
+        output = ArchiveOutput(args.archive, subdirs)
+    else:
+        output = DirectoryOutput(arg_output, subdirs)
+
+    dumps = DUMPS
+    if args.stream_admin_log:
+        stream = functools.partial(dump_admin_log_streaming, ndjson=args.stream_admin_log == "ndjson", itersize=args.itersize)
+        dumps = [stream if dump == dump_admin_log else dump for dump in dumps]
+
+    profile = Profile(args.explain, args.seq_scan_rows) if args.profile else None
+
+    start = time.perf_counter()
+    if args.jobs <= 1:
+        for dump in dumps:
+            run_dump(dump, cur, user_ids, output, profile)
+    else:
+        dump_parallel(conn, args.connection_string, args.jobs, dumps, user_ids, output, profile)
+
+    output.close()
+    conn.rollback()
+    conn.close()
+
+    if profile:
+        profile.save(args.profile, time.perf_counter() - start, len(user_ids), args.jobs)
+
+
+def run_dump(dump, cur: "psycopg2.cursor", user_ids: list, output, profile):
+    if profile:
+        profile.run(dump, cur, user_ids, output)
+    else:
+        dump(cur, user_ids, output)
+
+
+class CountingFile:
+    # Counts the bytes written through a text file.
+    def __init__(self, f, stats: dict):
+        self.f = f
+        self.stats = stats
+
+    def write(self, text: str):
+        self.stats["bytes"] += len(text.encode("utf-8"))
+        return self.f.write(text)
+
+
+class CountingOutput:
+    def __init__(self, output, stats: dict):
+        self.output = output
+        self.stats = stats
+
+    @contextlib.contextmanager
+    def open(self, user_id: str, name: str):
+        with self.output.open(user_id, name) as f:
+            yield CountingFile(f, self.stats)
+
+
+class RecordingCursor:
+    # Passes everything through to cur, keeping the queries run on it, and on any cursor opened
+    # from its connection, so they can be explained afterwards.
+    def __init__(self, cur, queries: list):
+        object.__setattr__(self, "cur", cur)
+        object.__setattr__(self, "queries", queries)
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+        return self.cur.execute(query, params)
+
+    @property
+    def connection(self):
+        return RecordingConnection(self.cur.connection, self.queries)
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.cur, name, value)
+
+
+class RecordingConnection:
+    def __init__(self, conn, queries: list):
+        self.conn = conn
+        self.queries = queries
+
+    def cursor(self, *args, **kwargs):
+        return RecordingCursor(self.conn.cursor(*args, **kwargs), self.queries)
+
+
+class Profile:
+    # Collects the wall time, rows and bytes of each dump, and optionally the EXPLAIN ANALYZE of its queries.
+    def __init__(self, explain: bool, seq_scan_rows: int):
+        self.explain = explain
+        self.seq_scan_rows = seq_scan_rows
+        self.tables = {}
+
+    def run(self, dump, cur: "psycopg2.cursor", user_ids: list, output):
+        name = getattr(dump, "func", dump).__name__.removeprefix("dump_").removesuffix("_streaming")
+        stats = {"seconds": 0.0, "rows": 0, "bytes": 0}
+        queries = []
+
+        start = time.perf_counter()
+        stats["rows"] = dump(RecordingCursor(cur, queries), user_ids, CountingOutput(output, stats))
+        stats["seconds"] = time.perf_counter() - start
+
+        if self.explain:
+            # Runs in the same transaction, so it sees the same snapshot as the dump did.
+            stats["plans"] = []
+            stats["seq_scans"] = []
+            for query, params in queries:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+                plan = cur.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                stats["plans"].append(plan[0])
+                stats["seq_scans"] += self.find_seq_scans(plan[0]["Plan"])
+
+        self.tables[name] = stats
+
+    def find_seq_scans(self, node: dict) -> list:
+        found = []
+        if node.get("Node Type") == "Seq Scan":
+            loops = node.get("Actual Loops", 1)
+            rows = (node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)) * loops
+            if rows >= self.seq_scan_rows:
+                found.append({"relation": node.get("Relation Name"), "rows_scanned": rows, "loops": loops})
+        for child in node.get("Plans", []):
+            found += self.find_seq_scans(child)
+        return found
+
+    def save(self, path: str, seconds: float, users: int, jobs: int):
+        report = {
+            "seconds": seconds,
+            "users": users,
+            "jobs": jobs,
+            "tables": dict(sorted(self.tables.items(), key=lambda table: -table[1]["seconds"])),
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+        for name, stats in report["tables"].items():
+            print(f"{name}: {stats['seconds']:.3f}s, {stats['rows']} rows, {stats['bytes']} bytes")
+            for scan in stats.get("seq_scans", []):
+                print(f"    sequential scan of {scan['relation']} through {scan['rows_scanned']} rows in {scan['loops']} loops")
+
+
+class DirectoryOutput:
+    # Each user's tables go into a subdirectory of outdir ("" for outdir itself).
+    def __init__(self, outdir: str, subdirs: dict):
+        self.outdirs = {user_id: os.path.join(outdir, subdir) for user_id, subdir in subdirs.items()}
+        for path in self.outdirs.values():
+            os.makedirs(path, exist_ok=True)
+
+    def open(self, user_id: str, name: str):
+        return open(os.path.join(self.outdirs[user_id], name), "w", encoding="utf-8")
+
+    def close(self):
+        pass
+
+
+class HashingWriter(io.RawIOBase):
+    # Passes writes through to f, hashing them on the way.
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.sha256.update(b)
+        self.f.write(b)
+        return len(b)
+
+
+class ArchiveOutput:
+    # Writes the tables straight into a .zip or .tar.gz as they're dumped, laid out like DirectoryOutput,
+    # and ends it with a SHA256SUMS member so it can be checked with sha256sum -c once extracted.
+    # Each member is spooled first, in memory unless it's big, and only copied into the archive once it's
+    # complete; a zip can only have one member open for writing and tar needs each member's size up front,
+    # but neither should hold up the other tables' workers while a member is still being dumped.
+    def __init__(self, path: str, subdirs: dict):
+        self.subdirs = subdirs
+        self.lock = threading.Lock()
+        self.sums = []
+        if path.endswith(".zip"):
+            self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, "w:gz")
+
+    @contextlib.contextmanager
+    def open(self, user_id: str, name: str):
+        member = f"{self.subdirs[user_id]}/{name}" if self.subdirs[user_id] else name
+
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as f:
+            hashing = HashingWriter(f)
+            text = io.TextIOWrapper(hashing, encoding="utf-8")
+            yield text
+            text.detach()
+            size = f.tell()
+            f.seek(0)
+            with self.lock:
+                if self.zip is not None:
+                    with self.zip.open(member, "w", force_zip64=True) as zf:
+                        shutil.copyfileobj(f, zf)
+                else:
+                    info = tarfile.TarInfo(member)
+                    info.size = size
+                    info.mtime = int(time.time())
+                    self.tar.addfile(info, f)
+
+        with self.lock:
+            self.sums.append(f"{hashing.sha256.hexdigest()}  {member}\n")
+
+    def close(self):
+        sums = "".join(sorted(self.sums, key=lambda line: line[66:])).encode()
+        if self.zip is not None:
+            self.zip.writestr("SHA256SUMS", sums)
+            self.zip.close()
+        else:
+            info = tarfile.TarInfo("SHA256SUMS")
+            info.size = len(sums)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(sums))
+            self.tar.close()
+
+
+def dump_parallel(conn: "psycopg2.connection", connection_string: str, jobs: int, dumps: list, user_ids: list, output, profile = None):
+    # Runs the dumps on a pool of connections. Each worker imports the snapshot of conn, which has to stay open
+    # until they're done, so they all see exactly what a single connection dumping the tables one by one would.
+    cur = conn.cursor()
+    cur.execute("SELECT pg_export_snapshot()")
+    snapshot = cur.fetchone()[0]
+
+    pool = psycopg2.pool.ThreadedConnectionPool(1, jobs, connection_string)
+
+    def run(dump):
+        worker_conn = pool.getconn()
+        try:
+            worker_conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+            worker_cur = worker_conn.cursor()
+            worker_cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+            run_dump(dump, worker_cur, user_ids, output, profile)
+        finally:
+            worker_conn.rollback()
+            pool.putconn(worker_conn)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for future in [executor.submit(run, dump) for dump in dumps]:
+                future.result()
+    finally:
+        pool.closeall()
 
 
 def check_schema_version(cur: "psycopg2.cursor", ignore_mismatch: bool):
@@ -61,31 +346,63 @@ def check_schema_version(cur: "psycopg2.cursor", ignore_mismatch: bool):
         exit(1)
 
 
-def normalize_user_id(cur: "psycopg2.cursor", name_or_uid: str) -> str:
-    try:
-        return str(UUID(name_or_uid))
-    except ValueError:
-        # Must be a name, get UUID from DB.
-        pass
-
-    cur.execute("SELECT user_id FROM player WHERE last_seen_user_name = %s ORDER BY last_seen_time DESC LIMIT 1", (name_or_uid,))
-    row = cur.fetchone()
-    if row == None:
-        print(f"Unable to find user '{name_or_uid}' in DB.")
-        exit(1)
-
-    print(f"Found user ID: {row[0]}")
-    return row[0]
-
-
-def dump_admin(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def normalize_user_ids(cur: "psycopg2.cursor", names_or_uids: list) -> list:
+    user_ids = {}
+    names = []
+    for name_or_uid in names_or_uids:
+        try:
+            user_ids[name_or_uid] = str(UUID(name_or_uid))
+        except ValueError:
+            # Must be a name, get UUID from DB.
+            names.append(name_or_uid)
+
+    if names:
+        # Every name in one go; the most recent player to use a name wins.
+        cur.execute("""
+SELECT DISTINCT ON (last_seen_user_name)
+    last_seen_user_name, user_id
+FROM
+    player
+WHERE
+    last_seen_user_name = ANY(%s)
+ORDER BY
+    last_seen_user_name, last_seen_time DESC
+""", (names,))
+        found = dict(cur.fetchall())
+
+        missing = [name for name in names if name not in found]
+        if missing:
+            print(f"Unable to find users {', '.join(repr(name) for name in missing)} in DB.")
+            exit(1)
+
+        for name in names:
+            print(f"Found user ID for {name}: {found[name]}")
+            user_ids[name] = str(found[name])
+
+    # The same user can be asked for by name and by ID.
+    return list(dict.fromkeys(user_ids[name_or_uid] for name_or_uid in names_or_uids))
+
+
+def write_per_user(rows: list, user_ids: list, output, name: str) -> int:
+    # rows are (user ID, JSON, row count); users with nothing in the table get an empty list.
+    # Returns how many rows were dumped in total.
+    json_by_user = {str(user_id): json_data for user_id, json_data, count in rows}
+    for user_id in user_ids:
+        with output.open(user_id, name) as f:
+            f.write(json_by_user.get(user_id, "[]"))
+    return sum(count for user_id, json_data, count in rows)
+
+
+def dump_admin(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping admin...")
 
     # #>> '{}' is to turn it into a string.
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_jsonb(data) - 'admin_rank_id'), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_jsonb(data) - 'admin_rank_id'), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -94,29 +411,22 @@ FROM (
         ) rank)
         as admin_rank,
         (SELECT COALESCE(json_agg(to_jsonb(flagg) - 'admin_id'), '[]') FROM (
-            SELECT * FROM admin_flag WHERE admin_id = %s
+            SELECT * FROM admin_flag WHERE admin_flag.admin_id = admin.user_id
         ) flagg)
         as admin_flags
     FROM
         admin
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id, user_id))
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    json_data = cur.fetchall()[0][0]
+    return write_per_user(cur.fetchall(), user_ids, output, "admin.json")
 
-    with open(os.path.join(outdir, "admin.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
-
-
-def dump_admin_log(cur: "psycopg2.cursor", user_id: str, outdir: str):
-    print("Dumping admin_log...")
 
-    cur.execute("""
-SELECT
-    COALESCE(json_agg(to_jsonb(data) - 'admin_log_id'), '[]') #>> '{}'
-FROM (
+ADMIN_LOG_ROWS = """
     SELECT
         *
     FROM
@@ -126,44 +436,89 @@ FROM (
     ON
         al.admin_log_id = alp.log_id AND al.round_id = alp.round_id
     WHERE
-        player_user_id = %s
-) as data
-""", (user_id,))
+        player_user_id = ANY(%s::uuid[])
+"""
 
-    json_data = cur.fetchall()[0][0]
 
-    with open(os.path.join(outdir, "admin_log.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+def dump_admin_log(cur: "psycopg2.cursor", user_ids: list, output):
+    print("Dumping admin_log...")
 
+    cur.execute(f"""
+SELECT
+    data.player_user_id,
+    COALESCE(json_agg(to_jsonb(data) - 'admin_log_id'), '[]') #>> '{{}}',
+    count(*)
+FROM ({ADMIN_LOG_ROWS}) as data
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
+
+    return write_per_user(cur.fetchall(), user_ids, output, "admin_log.json")
+
+
+def dump_admin_log_streaming(cur: "psycopg2.cursor", user_ids: list, output, ndjson: bool = False, itersize: int = 2000):
+    print("Dumping admin_log (streaming)...")
+
+    # A named cursor lives on the server and hands rows over itersize at a time,
+    # so neither side ever holds the whole log. Each user gets a query of their own, which the
+    # player_user_id index answers as it goes, rather than one that has to sort every user's rows first.
+    name = "admin_log.ndjson" if ndjson else "admin_log.json"
+    count = 0
+    for user_id in user_ids:
+        stream = cur.connection.cursor(name="dump_admin_log")
+        stream.itersize = itersize
+        stream.execute(f"""
+SELECT
+    (to_jsonb(data) - 'admin_log_id') #>> '{{}}'
+FROM ({ADMIN_LOG_ROWS}) as data
+""", ([user_id],))
 
-def dump_admin_notes(cur: "psycopg2.cursor", user_id: str, outdir: str):
+        with output.open(user_id, name) as f:
+            f.write("" if ndjson else "[")
+            for i, (row,) in enumerate(stream):
+                if i > 0 and not ndjson:
+                    f.write(", ")
+                f.write(row)
+                f.write("\n" if ndjson else "")
+                count += 1
+            f.write("" if ndjson else "]")
+
+        stream.close()
+
+    return count
+
+
+def dump_admin_notes(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping admin_notes...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.player_user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         admin_notes
     WHERE
-        player_user_id = %s
+        player_user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "admin_notes.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "admin_notes.json")
 
 
-def dump_connection_log(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_connection_log(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping connection_log...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -174,44 +529,46 @@ FROM (
     FROM
         connection_log
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "connection_log.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "connection_log.json")
 
 
-def dump_play_time(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_play_time(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping play_time...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}'
+    data.player_id,
+    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         play_time
     WHERE
-        player_id = %s
+        player_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
+GROUP BY
+    data.player_id
+""", (user_ids,))
 
-    json_data = cur.fetchall()[0][0]
+    return write_per_user(cur.fetchall(), user_ids, output, "play_time.json")
 
-    with open(os.path.join(outdir, "play_time.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
 
-
-def dump_player(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_player(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping player...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -222,24 +579,25 @@ FROM (
     FROM
         player
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "player.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "player.json")
 
 
-def dump_preference(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_preference(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping preference...")
 
     # God have mercy on my soul.
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_jsonb(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -267,22 +625,23 @@ FROM (
     FROM
         preference
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "preference.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "preference.json")
 
 
-def dump_server_ban(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_server_ban(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping server_ban...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.player_user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -293,44 +652,46 @@ FROM (
     FROM
         server_ban
     WHERE
-        player_user_id = %s
+        player_user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
 
-    json_data = cur.fetchall()[0][0]
+    return write_per_user(cur.fetchall(), user_ids, output, "server_ban.json")
 
-    with open(os.path.join(outdir, "server_ban.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
 
-
-def dump_server_ban_exemption(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_server_ban_exemption(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping server_ban_exemption...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         server_ban_exemption
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "server_ban_exemption.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "server_ban_exemption.json")
 
 
-def dump_server_role_ban(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_server_role_ban(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping server_role_ban...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.player_user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *,
@@ -341,103 +702,124 @@ FROM (
     FROM
         server_role_ban
     WHERE
-        player_user_id = %s
+        player_user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "server_role_ban.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "server_role_ban.json")
 
 
-def dump_uploaded_resource_log(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_uploaded_resource_log(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping uploaded_resource_log...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         uploaded_resource_log
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    json_data = cur.fetchall()[0][0]
+    return write_per_user(cur.fetchall(), user_ids, output, "uploaded_resource_log.json")
 
-    with open(os.path.join(outdir, "uploaded_resource_log.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
 
-
-def dump_whitelist(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_whitelist(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping whitelist...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         whitelist
     WHERE
-        user_id = %s
+        user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "whitelist.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "whitelist.json")
 
 
-def dump_admin_messages(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_admin_messages(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping admin_messages...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.player_user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         admin_messages
     WHERE
-        player_user_id = %s
+        player_user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
 
-    with open(os.path.join(outdir, "admin_messages.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
+    return write_per_user(cur.fetchall(), user_ids, output, "admin_messages.json")
 
 
-def dump_admin_watchlists(cur: "psycopg2.cursor", user_id: str, outdir: str):
+def dump_admin_watchlists(cur: "psycopg2.cursor", user_ids: list, output):
     print("Dumping admin_watchlists...")
 
     cur.execute("""
 SELECT
-    COALESCE(json_agg(to_json(data)), '[]') #>> '{}'
+    data.player_user_id,
+    COALESCE(json_agg(to_json(data)), '[]') #>> '{}',
+    count(*)
 FROM (
     SELECT
         *
     FROM
         admin_watchlists
     WHERE
-        player_user_id = %s
+        player_user_id = ANY(%s::uuid[])
 ) as data
-""", (user_id,))
-
-    json_data = cur.fetchall()[0][0]
-
-    with open(os.path.join(outdir, "admin_watchlists.json"), "w", encoding="utf-8") as f:
-        f.write(json_data)
-
+GROUP BY
+    data.player_user_id
+""", (user_ids,))
+
+    return write_per_user(cur.fetchall(), user_ids, output, "admin_watchlists.json")
+
+
+# The big log tables go first, so the slowest one isn't left to start on its own at the end.
+DUMPS = [
+    dump_admin_log,
+    dump_connection_log,
+    dump_admin,
+    dump_admin_messages,
+    dump_admin_notes,
+    dump_admin_watchlists,
+    dump_play_time,
+    dump_player,
+    dump_preference,
+    dump_server_ban,
+    dump_server_ban_exemption,
+    dump_server_role_ban,
+    dump_uploaded_resource_log,
+    dump_whitelist,
+]
 
 main()
 
@@ -22,65 +22,314 @@
 
 import PIL
 import PIL.Image
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
 import sys
+import time
 import iconsmooth_lib
 
-if len(sys.argv) != 5:
-    print("iconsmooth.py in.png METRICS <" + iconsmooth_lib.all_conv + "> OUTPREFIX")
+def dedup_report(input_name, states, plan):
+    groups = iconsmooth_lib.subtile_groups(states, plan)
+    total = sum([len(group) for group in groups])
+    lines = [f"{input_name}: {total} subtiles, {len(groups)} unique, {total - len(groups)} duplicates"]
+    for group in groups:
+        if len(group) > 1:
+            lines.append("    " + " = ".join([f"{state}/{iconsmooth_lib.direction_names[j]}" for (state, j), dst_rect in group]))
+    return "\n".join(lines)
+
+def open_sheet(input_name, metric_mode, conversion_mode, region=None, tile_offset=None, frames=None):
+    # Opens the sheet, or just the part of a larger atlas it lives in.
+    src_img = PIL.Image.open(input_name)
+    if region is None and tile_offset is None:
+        return src_img
+    tile_w, tile_h = iconsmooth_lib.resolve_metrics(metric_mode)[:2]
+    if region is None:
+        # The sheet starts that many tiles in, and is laid out the way iconsmooth_inv.py writes it for this mode.
+        mode = iconsmooth_lib.resolve_mode(conversion_mode)
+        region = (tile_offset[0] * tile_w, tile_offset[1] * tile_h, mode.tw * tile_w, mode.th * tile_h)
+    if getattr(src_img, "n_frames", 1) > 1:
+        raise Exception("--region and --tile-offset don't support animated images")
+    rows = None
+    if frames is None:
+        # Only decode as far down as the last tile the conversion mode reads.
+        plan = iconsmooth_lib.forward_plan(metric_mode, conversion_mode, region[2] // tile_w)
+        rows = plan.src_sizes[None][1]
+    return iconsmooth_lib.crop_region(src_img, region, rows)
+
+def convert(input_name, metric_mode, conversion_mode, out_prefix, rsi=False, rsi_license=None, rsi_copyright=None, png_profile="default", dedup=False, dedup_atlas=False, frames=None, delay=0.1, region=None, tile_offset=None, engine=None):
+    # Converts a single sheet and returns how long it took, in seconds, and the files it wrote.
+    start = time.perf_counter()
+
+    src_img = open_sheet(input_name, metric_mode, conversion_mode, region, tile_offset, frames)
+    source_frames = iconsmooth_lib.load_frames(src_img, frames, delay)
+    delays = [frame_delay for frame, frame_delay in source_frames]
+    frame_states = iconsmooth_lib.smooth_frames([frame for frame, frame_delay in source_frames], metric_mode, conversion_mode, engine)
+    states = frame_states[0]
+    animated = len(frame_states) > 1
+
+    if dedup or dedup_atlas:
+        tile_w = iconsmooth_lib.resolve_metrics(metric_mode)[0]
+        plan = iconsmooth_lib.forward_plan(metric_mode, conversion_mode, source_frames[0][0].size[0] // tile_w)
+    if dedup:
+        for i, frame_states_i in enumerate(frame_states):
+            print(dedup_report(input_name + (f" frame {i}" if animated else ""), frame_states_i, plan))
+    if dedup_atlas:
+        if animated:
+            raise Exception("--dedup-atlas only supports single-frame sheets")
+        # One copy of each distinct subtile, plus the offsets needed to put the states back together.
+        atlas, layout = iconsmooth_lib.subtile_atlas(states, plan)
+        iconsmooth_lib.save_pngs({out_prefix + "atlas.png": atlas}, png_profile)
+        with open(out_prefix + "atlas.json", "w", encoding="utf-8") as f:
+            json.dump(layout, f, indent=4)
+            f.write("\n")
+        written = [out_prefix + "atlas.png", out_prefix + "atlas.json"]
+    elif rsi:
+        if animated:
+            states = iconsmooth_lib.pack_frames(frame_states, metric_mode)
+        written = iconsmooth_lib.save_rsi(states, out_prefix, metric_mode, rsi_license, rsi_copyright, png_profile, delays)
+    elif animated:
+        written = iconsmooth_lib.save_animated_states(frame_states, delays, out_prefix, png_profile)
+    else:
+        written = iconsmooth_lib.save_states(states, out_prefix, png_profile)
+
+    return time.perf_counter() - start, written
+
+def cache_options(options):
+    # Every engine writes the same pixels, so switching engines shouldn't invalidate the cache.
+    return {name: value for name, value in options.items() if name != "engine"}
+
+def convert_cached(job, options, cache_name):
+    if cache_name is None:
+        convert(*job, **options)
+        return
+    cache = iconsmooth_lib.BuildCache(cache_name)
+    key = iconsmooth_lib.BuildCache.job_key([job[0]], job[1], job[2], cache_options(options))
+    if cache.is_fresh(job[3], key):
+        print(f"{job[3]}: up to date")
+        return
+    elapsed, written = convert(*job, **options)
+    cache.record(job[3], key, written)
+    cache.save()
+
+def read_manifest(manifest_name):
+    # One job per line: in.png METRICS MODE OUTPREFIX
+    # Blank lines and lines starting with # are ignored.
+    jobs = []
+    with open(manifest_name, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            fields = line.split()
+            if len(fields) != 4:
+                raise Exception(f"{manifest_name}:{line_no}: expected 4 fields (in.png METRICS MODE OUTPREFIX), got {len(fields)}")
+            jobs.append(tuple(fields))
+    return jobs
+
+def glob_jobs(pattern, metric_mode, conversion_mode, out_dir):
+    # Every matched sheet gets written as OUTDIR/<name>_0.png and so on.
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = []
+    for input_name in sorted(glob.glob(pattern)):
+        stem = os.path.splitext(os.path.basename(input_name))[0]
+        jobs.append((input_name, metric_mode, conversion_mode, os.path.join(out_dir, stem + "_")))
+    return jobs
+
+def check_rsi_attribution(jobs, options):
+    # A new meta.json has to say where the art came from; fail before converting anything rather than guess.
+    if options["rsi_license"] is not None and options["rsi_copyright"] is not None:
+        return
+    for job in jobs:
+        meta_name = os.path.join(os.path.dirname(job[3]), "meta.json")
+        if not os.path.exists(meta_name):
+            raise Exception(f"{meta_name} doesn't exist yet; creating it needs both --license and --copyright")
+
+def run_batch(jobs, max_workers, options, cache=None):
+    for job in jobs:
+        if job[2] not in iconsmooth_lib.conversion_modes:
+            raise Exception(f"unknown conversion mode {job[2]} for {job[0]}")
+    if options["rsi"]:
+        # Jobs run in parallel, so two of them updating the same meta.json would race.
+        rsi_dirs = [os.path.dirname(job[3]) for job in jobs]
+        for rsi_dir in set(rsi_dirs):
+            if rsi_dirs.count(rsi_dir) > 1:
+                raise Exception(f"several jobs write into {rsi_dir}; with --rsi each job needs its own .rsi directory")
+        check_rsi_attribution(jobs, options)
+
+    results = []
+    start = time.perf_counter()
+
+    # Jobs whose input and settings haven't changed since their outputs were written are skipped.
+    keys = {}
+    pending = []
+    for job in jobs:
+        if cache is not None:
+            try:
+                keys[job] = iconsmooth_lib.BuildCache.job_key([job[0]], job[1], job[2], cache_options(options))
+            except OSError as e:
+                print(f"{job[0]} -> {job[3]}: FAILED: {e}")
+                results.append((job, None, e))
+                continue
+            if cache.is_fresh(job[3], keys[job]):
+                results.append((job, "cached", None))
+                continue
+        pending.append(job)
+
+    if len(pending) > 0:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(convert, *job, **options): job for job in pending}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                try:
+                    elapsed, written = future.result()
+                    print(f"{job[0]} -> {job[3]}: {elapsed * 1000:.1f}ms")
+                    results.append((job, elapsed, None))
+                    if cache is not None:
+                        cache.record(job[3], keys[job], written)
+                except Exception as e:
+                    print(f"{job[0]} -> {job[3]}: FAILED: {e}")
+                    results.append((job, None, e))
+    if cache is not None:
+        cache.save()
+    wall = time.perf_counter() - start
+
+    # Summary table, in manifest order
+    order = {job: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda r: order[r[0]])
+    name_w = max([len(r[0][0]) for r in results] + [len("input")])
+    print()
+    print(f"{'input':<{name_w}}  {'metrics':<10}  {'mode':<10}  {'time':>10}")
+    for job, elapsed, error in results:
+        if error is not None:
+            status = "FAILED"
+        elif elapsed == "cached":
+            status = "cached"
+        else:
+            status = f"{elapsed * 1000:.1f}ms"
+        print(f"{job[0]:<{name_w}}  {job[1]:<10}  {job[2]:<10}  {status:>10}")
+    failed = len([r for r in results if r[2] is not None])
+    cached = len([r for r in results if r[1] == "cached"])
+    total = sum([r[1] for r in results if r[2] is None and r[1] != "cached"])
+    print()
+    print(f"{len(results)} jobs, {failed} failed, {cached} cached, {total:.2f}s total job time, {wall:.2f}s wall time")
+    return failed == 0
+
+def watch(list_jobs, options, interval):
+    # Everything runs in this one process, so PIL stays imported and blit plans stay compiled between saves.
+    # Every sheet is converted once when it is first seen, then again whenever its mtime or size changes.
+    stamps = {}
+    print(f"Watching for changes every {interval}s, Ctrl+C to stop.")
+    try:
+        while True:
+            try:
+                jobs = list_jobs()
+            except Exception as e:
+                # Probably a manifest that is being edited; try again next time round.
+                print(f"FAILED to list jobs: {e}")
+                jobs = []
+            for job in jobs:
+                try:
+                    stat = os.stat(job[0])
+                except OSError:
+                    continue
+                stamp = (stat.st_mtime_ns, stat.st_size)
+                if stamps.get(job) == stamp:
+                    continue
+                stamps[job] = stamp
+                try:
+                    elapsed, written = convert(*job, **options)
+                    print(f"{job[0]} -> {job[3]}: {elapsed * 1000:.1f}ms")
+                except Exception as e:
+                    # A half-written sheet fails to load; it gets retried once the save finishes and the stamp changes.
+                    print(f"{job[0]} -> {job[3]}: FAILED: {e}")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+def print_help():
+    print("iconsmooth.py in.png METRICS <" + iconsmooth_lib.all_conv + "> OUTPREFIX [--rsi]")
+    print("iconsmooth.py --batch MANIFEST [-j N]")
+    print("iconsmooth.py --glob PATTERN METRICS <" + iconsmooth_lib.all_conv + "> OUTDIR [-j N]")
     print("OUTPREFIX is something like, say, " + iconsmooth_lib.explain_prefix)
+    print("MANIFEST has one \"in.png METRICS MODE OUTPREFIX\" job per line.")
+    print("--rsi writes the states and a meta.json into the .rsi directory OUTPREFIX points into,")
+    print("  updating an existing meta.json; --license and --copyright set its fields, and are required")
+    print("  when there's no meta.json yet.")
+    print("--png-profile <" + "/".join(iconsmooth_lib.png_profiles.keys()) + "> trades PNG size for encoding time.")
+    print("--dedup reports subtiles that are repeated across states.")
+    print("--dedup-atlas writes OUTPREFIXatlas.png with each distinct subtile once, and OUTPREFIXatlas.json")
+    print("  with where each state's subtiles go, instead of the state PNGs.")
+    print("Animated PNGs and GIFs are smoothed frame by frame, keeping their frame durations.")
+    print("--frames N instead splits the sheet into N frames stacked top to bottom, each shown for --delay seconds")
+    print("  (default 0.1). Animated states are written as animated PNGs, or as RSI animations with --rsi.")
+    print("--region x,y,w,h reads the sheet from that part of a larger atlas, in pixels;")
+    print("  --tile-offset tx,ty instead starts it that many tiles in, sized like iconsmooth_inv.py's output for the mode.")
+    print("  Only the rows needed are decoded.")
+    print("--watch keeps running and reconverts any input sheet whose mtime or size changes,")
+    print("  checking every --interval seconds (default 0.25).")
+    print("--engine <" + "/".join(iconsmooth_lib.engines) + "> picks how subtiles are copied (default " + iconsmooth_lib.default_engine + ");")
+    print("  numpy is faster per sheet but slow to import, so it only pays off over many sheets in one process.")
+    print("--cache FILE skips jobs whose input, settings and outputs are unchanged since the last run.")
     print(iconsmooth_lib.explain_mm)
-    raise Exception("see printed help")
-
-# Input detail configuration
-input_name = sys.argv[1]
-metric_mode = sys.argv[2]
-conversion_mode = sys.argv[3]
-out_prefix = sys.argv[4]
-
-# Metric configuration
-tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = iconsmooth_lib.parse_metric_mode(metric_mode)
-
-# Output state configuration
-out_states = iconsmooth_lib.conversion_modes[conversion_mode].states
-
-# Source loading
-src_img = PIL.Image.open(input_name)
-
-input_row = src_img.size[0] // tile_w
-
-tiles = []
-# 48 is the amount of tiles that usually exist, but 56 covers walls with diagonal variants.
-for i in range(56):
-    tile = PIL.Image.new("RGBA", (tile_w, tile_h))
-    tx = i % input_row
-    ty = i // input_row
-    tile.paste(src_img, (tx * -tile_w, ty * -tile_h))
-    # now split that up
-    # note that THIS is where the weird ordering gets put into place
-    tile_a = PIL.Image.new("RGBA", (remtile_w, remtile_h))
-    tile_a.paste(tile,           (-subtile_w, -subtile_h))
-    tile_b = PIL.Image.new("RGBA", (subtile_w, subtile_h))
-    tile_b.paste(tile,           (         0,          0))
-    tile_c = PIL.Image.new("RGBA", (remtile_w, subtile_h))
-    tile_c.paste(tile,           (-subtile_w,          0))
-    tile_d = PIL.Image.new("RGBA", (subtile_w, remtile_h))
-    tile_d.paste(tile,           (         0, -subtile_h))
-    tiles.append([tile_a, tile_b, tile_c, tile_d])
-
-state_size = (tile_w * 2, tile_h * 2)
-
-for state in range(len(out_states)):
-    full = PIL.Image.new("RGBA", state_size)
-    full.paste(tiles[out_states[state][0]][0], (subtile_w, subtile_h))
-    full.paste(tiles[out_states[state][1]][1], (tile_w, 0))
-    full.paste(tiles[out_states[state][2]][2], (subtile_w, tile_h))
-    full.paste(tiles[out_states[state][3]][3], (tile_w, tile_h + subtile_h))
-    full.save(out_prefix + str(state) + ".png")
-
-full_finale = PIL.Image.new("RGBA", (tile_w, tile_h))
-full_finale.paste(tiles[out_states[0][0]][0], (subtile_w, subtile_h))
-full_finale.paste(tiles[out_states[0][1]][1], (0, 0))
-full_finale.paste(tiles[out_states[0][2]][2], (subtile_w, 0))
-full_finale.paste(tiles[out_states[0][3]][3], (0, subtile_h))
-full_finale.save(out_prefix + "full.png")
 
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--batch", type=str)
+    parser.add_argument("--glob", type=str)
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("--rsi", action="store_true")
+    parser.add_argument("--license", type=str, default=None)
+    parser.add_argument("--copyright", type=str, default=None)
+    parser.add_argument("--cache", type=str, default=None)
+    parser.add_argument("--png-profile", choices=list(iconsmooth_lib.png_profiles.keys()), default="default")
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--dedup-atlas", action="store_true")
+    parser.add_argument("--frames", type=int, default=None)
+    parser.add_argument("--delay", type=float, default=0.1)
+    parser.add_argument("--region", type=str, default=None)
+    parser.add_argument("--tile-offset", type=str, default=None)
+    parser.add_argument("--engine", choices=iconsmooth_lib.engines, default=iconsmooth_lib.default_engine)
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--interval", type=float, default=0.25)
+    parser.add_argument("-h", "--help", action="store_true")
+    args = parser.parse_args()
+
+    options = {"rsi": args.rsi, "rsi_license": args.license, "rsi_copyright": args.copyright, "png_profile": args.png_profile,
+               "dedup": args.dedup, "dedup_atlas": args.dedup_atlas, "frames": args.frames, "delay": args.delay, "engine": args.engine,
+               "region": iconsmooth_lib.parse_region(args.region) if args.region is not None else None,
+               "tile_offset": iconsmooth_lib.parse_tile_offset(args.tile_offset) if args.tile_offset is not None else None}
+    if args.region is not None and args.tile_offset is not None:
+        print_help()
+        raise Exception("--region and --tile-offset both say where the sheet is, pick one")
+    if args.rsi and args.dedup_atlas:
+        print_help()
+        raise Exception("--rsi and --dedup-atlas are different kinds of output, pick one")
+
+    # Watch mode re-reads the manifest and re-globs on every poll, so this is a function rather than a list.
+    if args.batch is not None and len(args.args) == 0 and args.glob is None:
+        list_jobs = lambda: read_manifest(args.batch)
+    elif args.glob is not None and len(args.args) == 3 and args.batch is None:
+        list_jobs = lambda: glob_jobs(args.glob, *args.args)
+    elif args.batch is None and args.glob is None and len(args.args) == 4 and not args.help:
+        list_jobs = lambda: [tuple(args.args)]
+    else:
+        print_help()
+        raise Exception("see printed help")
+
+    if args.watch:
+        watch(list_jobs, options, args.interval)
+    elif args.batch is None and args.glob is None:
+        if args.rsi:
+            check_rsi_attribution(list_jobs(), options)
+        convert_cached(args.args, options, args.cache)
+    else:
+        cache = iconsmooth_lib.BuildCache(args.cache) if args.cache is not None else None
+        if not run_batch(list_jobs(), args.jobs, options, cache):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2022 Space Wizards Federation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Benchmarks and round-trip checks for iconsmooth_lib, run on synthetic sheets so no art is needed.
+
+import PIL
+import PIL.Image
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import iconsmooth_lib
+
+try:
+    import resource
+except ImportError:
+    # Peak memory is only measured where getrusage exists.
+    resource = None
+
+# What iconsmooth.py used to slice out of every sheet, regardless of mode.
+legacy_tile_count = 56
+
+# Width and height of the synthetic atlas the region benchmark cuts sheets out of.
+region_atlas_size = 4096
+
+def synthetic_sheet(metrics, mode, seed=0):
+    # A sheet of random opaque pixels laid out the way the mode expects its source,
+    # i.e. conversion_mode.tw by conversion_mode.th tiles.
+    tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = iconsmooth_lib.resolve_metrics(metrics)
+    conversion_mode = iconsmooth_lib.resolve_mode(mode)
+    size = (tile_w * conversion_mode.tw, tile_h * conversion_mode.th)
+    data = random.Random(seed).randbytes(size[0] * size[1] * 3)
+    return PIL.Image.frombytes("RGB", size, data).convert("RGBA")
+
+def legacy_extract(src_img, metrics):
+    # The extraction loop iconsmooth.py ran before it went demand-driven, kept here as a baseline.
+    tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = metrics
+    input_row = src_img.size[0] // tile_w
+    tiles = []
+    for i in range(legacy_tile_count):
+        tile = PIL.Image.new("RGBA", (tile_w, tile_h))
+        tile.paste(src_img, ((i % input_row) * -tile_w, (i // input_row) * -tile_h))
+        quadrants = []
+        for j in range(4):
+            qx, qy, qw, qh = iconsmooth_lib._quadrant_rect(metrics, j)
+            quadrant = PIL.Image.new("RGBA", (qw, qh))
+            quadrant.paste(tile, (-qx, -qy))
+            quadrants.append(quadrant)
+        tiles.append(quadrants)
+    return tiles
+
+def time_call(fn, iterations):
+    # Best of N, in milliseconds.
+    best = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+def available_engines():
+    return [engine for engine in iconsmooth_lib.engines if engine == "pil" or iconsmooth_lib.numpy_available()]
+
+def bench_extract(metric_mode, iterations):
+    metrics = iconsmooth_lib.resolve_metrics(metric_mode)
+    engines = available_engines()
+
+    header = f"{'mode':<12} {'tiles':>7} {'quadrants':>11} {'legacy':>10}"
+    for engine in engines:
+        header += f" {engine:>10}"
+    print(f"METRICS {metric_mode}, best of {iterations}; tiles and quadrants are now/legacy, times in ms")
+    print(header)
+
+    for name, conversion_mode in iconsmooth_lib.conversion_modes.items():
+        sheet = synthetic_sheet(metrics, conversion_mode)
+        input_row = sheet.size[0] // metrics[0]
+        plan = iconsmooth_lib.forward_plan(metrics, conversion_mode, input_row)
+
+        tiles = len(iconsmooth_lib.referenced_tiles(conversion_mode))
+        quadrants = len({src_rect for src_rect, dst_rect in plan.blits})
+
+        legacy_ms = time_call(lambda: legacy_extract(sheet, metrics), iterations)
+        line = f"{name:<12} {tiles:>3}/{legacy_tile_count:<3} {quadrants:>5}/{legacy_tile_count * 4:<5} {legacy_ms:>10.2f}"
+        for engine in engines:
+            engine_ms = time_call(lambda: iconsmooth_lib.smooth(sheet, metrics, conversion_mode, engine), iterations)
+            line += f" {engine_ms:>10.2f}"
+        print(line)
+
+    print()
+    print("legacy is extraction alone; engine columns are a whole smooth() including extraction.")
+    return True
+
+def check_roundtrip(sheet, metrics, conversion_mode, engine):
+    # Returns a list of problems; empty if unsmooth inverts smooth for this sheet.
+    tile_w, tile_h = metrics[:2]
+    problems = []
+    states = iconsmooth_lib.smooth(sheet, metrics, conversion_mode, engine)
+    restored = iconsmooth_lib.unsmooth(states, metrics, conversion_mode, engine)
+    if restored.size != sheet.size:
+        return [f"restored sheet is {restored.size}, expected {sheet.size}"]
+
+    # Only quadrants some state shows can come back; everything else is left transparent.
+    referenced = {(tile, j) for state in conversion_mode.states for j, tile in enumerate(state) if tile != -1}
+    blank = PIL.Image.new("RGBA", (tile_w, tile_h))
+    for tile in range(conversion_mode.tw * conversion_mode.th):
+        for j in range(4):
+            qx, qy, qw, qh = iconsmooth_lib._quadrant_rect(metrics, j)
+            x = (tile % conversion_mode.tw) * tile_w + qx
+            y = (tile // conversion_mode.tw) * tile_h + qy
+            box = (x, y, x + qw, y + qh)
+            expected = sheet.crop(box) if (tile, j) in referenced else blank.crop((0, 0, qw, qh))
+            if restored.crop(box).tobytes() != expected.tobytes():
+                problems.append(f"tile {tile} quadrant {j} differs after a round trip")
+
+    # Smoothing what was restored has to give back the same states.
+    again = iconsmooth_lib.smooth(restored, metrics, conversion_mode, engine)
+    for state in states:
+        if again[state].tobytes() != states[state].tobytes():
+            problems.append(f"state {state} differs after smoothing the restored sheet")
+    return problems
+
+def bench_roundtrip(metric_mode, iterations):
+    metrics = iconsmooth_lib.resolve_metrics(metric_mode)
+    engines = available_engines()
+    ok = True
+
+    header = f"{'mode':<12} {'check':>6}"
+    for engine in engines:
+        header += f" {engine + ' fwd':>12} {engine + ' inv':>12}"
+    print(f"METRICS {metric_mode}, best of {iterations}; throughput in source tiles/sec")
+    print(header)
+
+    for name, conversion_mode in iconsmooth_lib.conversion_modes.items():
+        sheet = synthetic_sheet(metrics, conversion_mode)
+        tiles = conversion_mode.tw * conversion_mode.th
+
+        problems = []
+        outputs = []
+        for engine in engines:
+            problems += [engine + ": " + problem for problem in check_roundtrip(sheet, metrics, conversion_mode, engine)]
+            states = iconsmooth_lib.smooth(sheet, metrics, conversion_mode, engine)
+            outputs.append([states[state].tobytes() for state in states])
+        # Every engine has to produce exactly the same pixels.
+        for engine, output in zip(engines[1:], outputs[1:]):
+            if output != outputs[0]:
+                problems.append(f"{engine} output differs from {engines[0]}")
+
+        line = f"{name:<12} {'ok' if len(problems) == 0 else 'FAILED':>6}"
+        for engine in engines:
+            states = iconsmooth_lib.smooth(sheet, metrics, conversion_mode, engine)
+            forward_ms = time_call(lambda: iconsmooth_lib.smooth(sheet, metrics, conversion_mode, engine), iterations)
+            inverse_ms = time_call(lambda: iconsmooth_lib.unsmooth(states, metrics, conversion_mode, engine), iterations)
+            line += f" {tiles / forward_ms * 1000:>12.0f} {tiles / inverse_ms * 1000:>12.0f}"
+        print(line)
+        for problem in problems:
+            print("    " + problem)
+        ok = ok and len(problems) == 0
+
+    return ok
+
+def _region_probe(atlas_name, region, metric_mode, mode_name, limited):
+    # Runs in a fresh process; returns (seconds, peak RSS in MB) for loading the sheet and smoothing it.
+    start = time.perf_counter()
+    src_img = PIL.Image.open(atlas_name)
+    if limited:
+        tile_w = iconsmooth_lib.resolve_metrics(metric_mode)[0]
+        plan = iconsmooth_lib.forward_plan(metric_mode, mode_name, region[2] // tile_w)
+        sheet = iconsmooth_lib.crop_region(src_img, region, plan.src_sizes[None][1])
+    else:
+        x, y, w, h = region
+        sheet = src_img.crop((x, y, x + w, y + h))
+    iconsmooth_lib.smooth(sheet, metric_mode, mode_name)
+    elapsed = time.perf_counter() - start
+    return elapsed, _peak_rss_mb()
+
+def _peak_rss_mb():
+    # On Linux ru_maxrss survives exec, so a spawned child would report its parent's peak; VmHWM doesn't.
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _baseline_probe():
+    PIL.Image.new("RGBA", (1, 1))
+    return _peak_rss_mb()
+
+def _run_probe(fn, *args):
+    # Each measurement gets its own process, so peak RSS isn't polluted by earlier ones.
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(fn, *args).result()
+
+def bench_region(metric_mode, iterations):
+    if resource is None:
+        print("the region benchmark needs the resource module, which this platform doesn't have")
+        return True
+    metrics = iconsmooth_lib.resolve_metrics(metric_mode)
+    mode_name = "tg"
+    sheet = synthetic_sheet(metrics, mode_name)
+
+    print(f"METRICS {metric_mode}, mode {mode_name}, {region_atlas_size}x{region_atlas_size} atlas, best of {iterations}")
+    print(f"{'position':<10} {'full ms':>10} {'full MB':>10} {'region ms':>10} {'region MB':>10}")
+    # Random pixels everywhere, so the atlas doesn't compress down to nothing.
+    background = PIL.Image.frombytes("RGB", (region_atlas_size, region_atlas_size), random.Random(1).randbytes(region_atlas_size * region_atlas_size * 3)).convert("RGBA")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for position, y in [("top", 0), ("middle", (region_atlas_size - sheet.size[1]) // 2), ("bottom", region_atlas_size - sheet.size[1])]:
+            atlas = background.copy()
+            region = (0, y, sheet.size[0], sheet.size[1])
+            atlas.paste(sheet, region[:2])
+            atlas_name = os.path.join(temp_dir, "atlas.png")
+            atlas.save(atlas_name, compress_level=1)
+            del atlas
+
+            line = f"{position:<10}"
+            for limited in [False, True]:
+                runs = [_run_probe(_region_probe, atlas_name, region, metric_mode, mode_name, limited) for _ in range(iterations)]
+                line += f" {min(r[0] for r in runs) * 1000:>10.1f} {min(r[1] for r in runs):>10.1f}"
+            print(line)
+    print()
+    print(f"MB is peak RSS of the whole process; the interpreter and PIL alone take {_run_probe(_baseline_probe):.1f}MB.")
+    return True
+
+benchmarks = {
+    "extract": bench_extract,
+    "roundtrip": bench_roundtrip,
+    "region": bench_region,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark iconsmooth_lib on synthetic sheets",
+                                     epilog=iconsmooth_lib.explain_mm,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=list(benchmarks.keys()))
+    parser.add_argument("--metrics", type=str, action="append",
+                        help="METRICS to generate sheets for; can be given several times (default: 32, 32x48 and 32.12x20)")
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="runs per measurement; the best one is reported")
+    args = parser.parse_args()
+
+    ok = True
+    for metric_mode in args.metrics or ["32", "32x48", "32.12x20"]:
+        ok = benchmarks[args.benchmark](metric_mode, args.iterations) and ok
+        print()
+
+    if not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
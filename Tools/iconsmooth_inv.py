@@ -20,63 +20,46 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import PIL
-import PIL.Image
-import sys
+import argparse
 import iconsmooth_lib
 
-if len(sys.argv) != 5:
-    print("iconsmooth_inv.py INPREFIX METRICS <" + iconsmooth_lib.all_conv + "> out.png")
-    print("INPREFIX is something like, say, " + iconsmooth_lib.explain_prefix)
-    print(iconsmooth_lib.explain_mm)
-    raise Exception("see printed help")
-# Input detail configuration
-input_prefix = sys.argv[1]
-metric_mode = sys.argv[2]
-conversion_mode = iconsmooth_lib.conversion_modes[sys.argv[3]]
-output_name = sys.argv[4]
+def convert(input_prefix, metric_mode, conversion_mode, output_name, png_profile="default", engine=None):
+    states = iconsmooth_lib.load_states(input_prefix)
+    full_finale = iconsmooth_lib.unsmooth(states, metric_mode, conversion_mode, engine)
+    iconsmooth_lib.save_pngs({output_name: full_finale}, png_profile)
+    return [output_name]
 
-tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = iconsmooth_lib.parse_metric_mode(metric_mode)
+def convert_cached(job, cache_name, png_profile, engine):
+    if cache_name is None:
+        convert(*job, png_profile, engine)
+        return
+    input_prefix, metric_mode, conversion_mode, output_name = job
+    cache = iconsmooth_lib.BuildCache(cache_name)
+    input_names = [input_prefix + str(j) + ".png" for j in range(iconsmooth_lib.state_count)]
+    key = iconsmooth_lib.BuildCache.job_key(input_names, metric_mode, conversion_mode, {"png_profile": png_profile})
+    if cache.is_fresh(output_name, key):
+        print(f"{output_name}: up to date")
+        return
+    cache.record(output_name, key, convert(*job, png_profile, engine))
+    cache.save()
 
-# Source loading
-tiles = []
+def main():
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--cache", type=str, default=None)
+    parser.add_argument("--png-profile", choices=list(iconsmooth_lib.png_profiles.keys()), default="default")
+    parser.add_argument("--engine", choices=iconsmooth_lib.engines, default=iconsmooth_lib.default_engine)
+    parser.add_argument("-h", "--help", action="store_true")
+    args = parser.parse_args()
 
-for j in range(8):
-    src_img = PIL.Image.open(input_prefix + str(j) + ".png")
-
-    tile_a = PIL.Image.new("RGBA", (remtile_w, remtile_h))
-    tile_a.paste(src_img, (-subtile_w, -subtile_h))
-    tile_b = PIL.Image.new("RGBA", (subtile_w, subtile_h))
-    tile_b.paste(src_img, (-tile_w, 0))
-    tile_c = PIL.Image.new("RGBA", (remtile_w, subtile_h))
-    tile_c.paste(src_img, (-subtile_w, -tile_h))
-    tile_d = PIL.Image.new("RGBA", (subtile_w, remtile_h))
-    tile_d.paste(src_img, (-tile_w, -(tile_h + subtile_h)))
-    tiles.append([tile_a, tile_b, tile_c, tile_d])
-
-# Prepare finale
-output_tw = conversion_mode.tw
-output_th = conversion_mode.th
-
-full_finale = PIL.Image.new("RGBA", (tile_w * output_tw, tile_h * output_th))
-
-# State table to be inverted
-out_states = conversion_mode.states
-
-# Directions to subtile offsets
-subtile_ofx = [1, 0, 1, 0]
-subtile_ofy = [1, 0, 0, 1]
-
-for i in [7, 6, 5, 4, 3, 2, 1, 0]:
-    for j in range(4):
-        target_tile = out_states[i][j]
-        if target_tile != -1:
-            target_stx = (target_tile % output_tw) * tile_w
-            target_sty = (target_tile // output_tw) * tile_h
-            target_stx += subtile_ofx[j] * subtile_w
-            target_sty += subtile_ofy[j] * subtile_h
-            full_finale.paste(tiles[i][j], (target_stx, target_sty))
-
-# Done!
-full_finale.save(output_name)
+    if len(args.args) != 4 or args.help:
+        print("iconsmooth_inv.py INPREFIX METRICS <" + iconsmooth_lib.all_conv + "> out.png [--cache FILE] [--png-profile <" + "/".join(iconsmooth_lib.png_profiles.keys()) + ">] [--engine <" + "/".join(iconsmooth_lib.engines) + ">]")
+        print("INPREFIX is something like, say, " + iconsmooth_lib.explain_prefix)
+        print("--cache FILE skips the conversion if the inputs, settings and output are unchanged since the last run.")
+        print("--engine picks how subtiles are copied, default " + iconsmooth_lib.default_engine + "; numpy gives the same output but is slow to import.")
+        print(iconsmooth_lib.explain_mm)
+        raise Exception("see printed help")
+    convert_cached(args.args, args.cache, args.png_profile, args.engine)
 
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import PIL
+import PIL.Image
+import concurrent.futures
+import hashlib
+import importlib.util
+import json
+import math
+import os
+import png_strips
+
 class ConversionMode:
     def __init__(self, tw, th, states):
         self.tw = tw
@@ -195,3 +205,509 @@ REM is computed from subtracting the subtile size from the tile size.
 
 explain_prefix = "Resources/Textures/Structures/catwalk.rsi/catwalk_"
 
+
+# Number of output states produced by every conversion mode.
+state_count = 8
+
+# Directions to subtile offsets, in the BR, TL, TR, BL order used by ConversionMode.states.
+# Each direction of an output state holds one quadrant of its tile:
+#
+# TL | TR
+# ---+---
+# BL | BR
+#
+subtile_ofx = [1, 0, 1, 0]
+subtile_ofy = [1, 0, 0, 1]
+direction_names = ["BR", "TL", "TR", "BL"]
+
+engines = ["numpy", "pil"]
+
+# numpy is only imported once the numpy engine actually runs; importing it costs more than a whole
+# single-sheet conversion with PIL, so that's the default and numpy is opt-in for long-running batches.
+default_engine = "pil"
+
+def numpy_available():
+    return importlib.util.find_spec("numpy") is not None
+
+def resolve_metrics(metrics):
+    # Accepts either a METRICS string or an already-parsed parse_metric_mode tuple.
+    if isinstance(metrics, str):
+        return parse_metric_mode(metrics)
+    return tuple(metrics)
+
+def resolve_mode(mode):
+    # Accepts either a conversion mode name or a ConversionMode.
+    if isinstance(mode, ConversionMode):
+        return mode
+    if mode not in conversion_modes:
+        raise Exception("unknown conversion mode " + str(mode) + ", expected one of " + all_conv)
+    return conversion_modes[mode]
+
+class BlitPlan:
+    # A conversion compiled down to a flat list of rectangle copies.
+    # Images are identified by key: None is the source sheet, states are 0..7 and "full".
+    # Each blit is ((src_key, x, y, w, h), (dst_key, x, y, w, h)); later blits overwrite earlier ones.
+    def __init__(self, src_sizes, dst_sizes, blits, labels):
+        # key -> (w, h) of the part of each source the plan reads from;
+        # anything past the edge of a smaller source reads as transparent
+        self.src_sizes = src_sizes
+        # key -> (w, h) of each image the plan produces
+        self.dst_sizes = dst_sizes
+        self.blits = blits
+        # (state, direction) each blit belongs to, for reporting
+        self.labels = labels
+
+def _quadrant_rect(metrics, j):
+    # Position and size of quadrant j within a tile.
+    tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = metrics
+    return (
+        subtile_ofx[j] * subtile_w,
+        subtile_ofy[j] * subtile_h,
+        remtile_w if subtile_ofx[j] else subtile_w,
+        remtile_h if subtile_ofy[j] else subtile_h,
+    )
+
+def _add_blit(blits, labels, label, dst_sizes, src_key, sx, sy, dst_key, dx, dy, w, h):
+    # Clip against the destination here, so executing a plan never has to.
+    dst_w, dst_h = dst_sizes[dst_key]
+    if dx < 0:
+        sx, w, dx = sx - dx, w + dx, 0
+    if dy < 0:
+        sy, h, dy = sy - dy, h + dy, 0
+    w = min(w, dst_w - dx)
+    h = min(h, dst_h - dy)
+    if w > 0 and h > 0:
+        blits.append(((src_key, sx, sy, w, h), (dst_key, dx, dy, w, h)))
+        labels.append(label)
+
+def referenced_tiles(mode):
+    # Source tile indices a conversion mode actually reads, in ascending order.
+    conversion_mode = resolve_mode(mode)
+    return sorted({tile for state in conversion_mode.states for tile in state if tile != -1})
+
+_forward_plans = {}
+
+def forward_plan(metrics, mode, input_row):
+    # Plan for smooth(). input_row is the width of the source sheet in tiles.
+    # Only quadrants of tiles the mode references are read, and the source is only loaded as far as the last of them.
+    # Plans are memoized, so every sheet sharing the same geometry reuses one.
+    metrics = resolve_metrics(metrics)
+    conversion_mode = resolve_mode(mode)
+    key = (metrics, conversion_mode, input_row)
+    plan = _forward_plans.get(key)
+    if plan is None:
+        plan = _compile_forward_plan(metrics, conversion_mode, input_row)
+        _forward_plans[key] = plan
+    return plan
+
+def _compile_forward_plan(metrics, conversion_mode, input_row):
+    tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = metrics
+    out_states = conversion_mode.states
+
+    dst_sizes = {state: (tile_w * 2, tile_h * 2) for state in range(len(out_states))}
+    dst_sizes["full"] = (tile_w, tile_h)
+    blits = []
+    labels = []
+    src_w, src_h = 0, 0
+
+    def add(state, j, dst_key, dx, dy):
+        nonlocal src_w, src_h
+        tile = out_states[state][j]
+        qx, qy, qw, qh = _quadrant_rect(metrics, j)
+        sx = (tile % input_row) * tile_w + qx
+        sy = (tile // input_row) * tile_h + qy
+        src_w = max(src_w, sx + qw)
+        src_h = max(src_h, sy + qh)
+        _add_blit(blits, labels, (dst_key, j), dst_sizes, None, sx, sy, dst_key, dx + qx, dy + qy, qw, qh)
+
+    # Each direction of a state is one tile of the 2x2 RSI sheet, and only shows quadrant j of it.
+    for state in range(len(out_states)):
+        for j in range(4):
+            add(state, j, state, (j % 2) * tile_w, (j // 2) * tile_h)
+
+    # The full tile puts the quadrants of state 0 back together.
+    for j in range(4):
+        add(0, j, "full", 0, 0)
+
+    return BlitPlan({None: (src_w, src_h)}, dst_sizes, blits, labels)
+
+_inverse_plans = {}
+
+def inverse_plan(metrics, mode):
+    # Plan for unsmooth(), memoized like forward_plan.
+    metrics = resolve_metrics(metrics)
+    conversion_mode = resolve_mode(mode)
+    key = (metrics, conversion_mode)
+    plan = _inverse_plans.get(key)
+    if plan is None:
+        plan = _compile_inverse_plan(metrics, conversion_mode)
+        _inverse_plans[key] = plan
+    return plan
+
+def _compile_inverse_plan(metrics, conversion_mode):
+    tile_w, tile_h, subtile_w, subtile_h, remtile_w, remtile_h = metrics
+
+    # Prepare finale
+    output_tw = conversion_mode.tw
+    output_th = conversion_mode.th
+
+    # State table to be inverted
+    out_states = conversion_mode.states
+
+    src_sizes = {i: (tile_w * 2, tile_h * 2) for i in range(len(out_states))}
+    dst_sizes = {None: (tile_w * output_tw, tile_h * output_th)}
+    blits = []
+    labels = []
+
+    # Lower states are written last, so they win where several states share a subtile.
+    for i in reversed(range(len(out_states))):
+        for j in range(4):
+            target_tile = out_states[i][j]
+            if target_tile != -1:
+                qx, qy, qw, qh = _quadrant_rect(metrics, j)
+                target_stx = (target_tile % output_tw) * tile_w + qx
+                target_sty = (target_tile // output_tw) * tile_h + qy
+                _add_blit(blits, labels, (i, j), dst_sizes, i, (j % 2) * tile_w + qx, (j // 2) * tile_h + qy, None, target_stx, target_sty, qw, qh)
+
+    return BlitPlan(src_sizes, dst_sizes, blits, labels)
+
+def _load_source(img, size):
+    # Only the part of a source a plan actually reads from is converted.
+    w = min(img.size[0], size[0])
+    h = min(img.size[1], size[1])
+    if img.size != (w, h):
+        img = img.crop((0, 0, w, h))
+    # Pasting into an RGBA image converts the source the same way, so both engines see the same pixels.
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+    # Anything past the edge of the source reads as transparent, which is what pasting it did.
+    if img.size != size:
+        padded = PIL.Image.new("RGBA", size)
+        padded.paste(img, (0, 0))
+        img = padded
+    return img
+
+def _execute_pil(plan, sources):
+    sources = {key: _load_source(img, plan.src_sizes[key]) for key, img in sources.items()}
+    result = {key: PIL.Image.new("RGBA", size) for key, size in plan.dst_sizes.items()}
+    # Several states usually show the same quadrant of a tile, so each one is only cropped once.
+    crops = {}
+    for src_rect, (dst_key, dx, dy, _, _) in plan.blits:
+        crop = crops.get(src_rect)
+        if crop is None:
+            src_key, sx, sy, w, h = src_rect
+            crop = sources[src_key].crop((sx, sy, sx + w, sy + h))
+            crops[src_rect] = crop
+        result[dst_key].paste(crop, (dx, dy))
+    return result
+
+def _execute_numpy(plan, sources):
+    import numpy
+    # Load each source once as an (H, W, 4) array; every blit is then a slice of it.
+    arrays = {key: numpy.asarray(_load_source(img, plan.src_sizes[key])) for key, img in sources.items()}
+    result = {key: numpy.zeros((size[1], size[0], 4), dtype=numpy.uint8) for key, size in plan.dst_sizes.items()}
+    for (src_key, sx, sy, w, h), (dst_key, dx, dy, _, _) in plan.blits:
+        result[dst_key][dy:dy + h, dx:dx + w] = arrays[src_key][sy:sy + h, sx:sx + w]
+    return {key: PIL.Image.fromarray(array, "RGBA") for key, array in result.items()}
+
+def execute_plan(plan, sources, engine=None):
+    # Runs a plan over {key: Image} sources and returns {key: Image} results.
+    engine = engine or default_engine
+    if engine == "numpy":
+        if not numpy_available():
+            raise Exception("the numpy engine needs numpy installed")
+        return _execute_numpy(plan, sources)
+    if engine == "pil":
+        return _execute_pil(plan, sources)
+    raise Exception("unknown engine " + str(engine) + ", expected one of " + "/".join(engines))
+
+def smooth(image, metrics, mode, engine=None):
+    # Converts a source sheet into smoothing states, entirely in memory.
+    # Returns {0: Image, ..., 7: Image, "full": Image}, each state being a 4-direction RSI sheet.
+    metrics = resolve_metrics(metrics)
+    input_row = image.size[0] // metrics[0]
+    plan = forward_plan(metrics, mode, input_row)
+    return execute_plan(plan, {None: image}, engine)
+
+def parse_region(region):
+    # "x,y,w,h" in pixels
+    sp = [int(v) for v in region.split(",")]
+    if len(sp) != 4:
+        raise Exception("a region is x,y,w,h, not " + region)
+    return tuple(sp)
+
+def parse_tile_offset(tile_offset):
+    # "tx,ty" in tiles
+    sp = [int(v) for v in tile_offset.split(",")]
+    if len(sp) != 2:
+        raise Exception("a tile offset is tx,ty, not " + tile_offset)
+    return tuple(sp)
+
+def crop_region(image, region, rows=None):
+    # Returns region = (x, y, w, h) of a freshly opened, not yet loaded image.
+    # If rows is given, only that many rows of the region are needed and the result is cut short after them.
+    # PNGs png_strips can decode are read a strip at a time: strips above the region are unfiltered and dropped,
+    # only the region's columns of the rest are kept, and nothing below it is ever decompressed.
+    x, y, w, h = region
+    if rows is not None:
+        h = min(h, rows)
+    filename = getattr(image, "filename", None)
+    if image.format != "PNG" or not filename or getattr(image, "n_frames", 1) != 1 or png_strips.png_header(filename) is None:
+        return image.crop((x, y, x + w, y + h))
+
+    # Anything outside the image stays zero, the same as crop() past the edge.
+    result = PIL.Image.new(image.mode, (w, h))
+    if image.mode == "P":
+        result.putpalette(image.palette)
+    if "transparency" in image.info:
+        result.info["transparency"] = image.info["transparency"]
+    for strip_y, strip in png_strips.read_png_strips(filename):
+        top = max(y, strip_y)
+        bottom = min(y + h, strip_y + strip.height)
+        if top < bottom:
+            result.paste(strip.crop((x, top - strip_y, x + w, bottom - strip_y)), (0, top - y))
+        if strip_y + strip.height >= y + h:
+            break
+    return result
+
+def load_frames(image, frames=None, delay=0.1):
+    # Splits a source into its animation frames, returning [(Image, delay in seconds)].
+    # With frames set, the sheet holds that many frames stacked top to bottom, each shown for delay.
+    # Otherwise animated images (APNG, GIF) use their own frames and durations, and anything else is one frame.
+    if frames is not None:
+        if image.size[1] % frames != 0:
+            raise Exception("sheet is " + str(image.size[1]) + " pixels high, which doesn't split into " + str(frames) + " frames")
+        frame_h = image.size[1] // frames
+        return [(image.crop((0, i * frame_h, image.size[0], (i + 1) * frame_h)), delay) for i in range(frames)]
+    if getattr(image, "n_frames", 1) == 1:
+        return [(image, delay)]
+    result = []
+    for i in range(image.n_frames):
+        image.seek(i)
+        result.append((image.convert("RGBA"), image.info.get("duration", delay * 1000) / 1000))
+    image.seek(0)
+    return result
+
+def smooth_frames(images, metrics, mode, engine=None):
+    # smooth() for every frame of an animation, run concurrently; returns one states dict per frame.
+    # The NumPy copies and PIL's conversions release the GIL, so threads are enough here.
+    if len(images) == 1:
+        return [smooth(images[0], metrics, mode, engine)]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        return list(executor.map(lambda image: smooth(image, metrics, mode, engine), images))
+
+def pack_frames(frame_states, metrics):
+    # Packs per-frame states into one sheet per state, laid out the way an RSI stores animations:
+    # all frames of the first direction, then all frames of the next, left to right and top to bottom,
+    # wrapping at ceil(sqrt(count)) columns. A single frame packs to exactly the state smooth() gave.
+    tile_w, tile_h = resolve_metrics(metrics)[:2]
+    result = {}
+    for state in frame_states[0]:
+        directions = 1 if state == "full" else 4
+        count = directions * len(frame_states)
+        columns = math.ceil(math.sqrt(count))
+        rows = (count + columns - 1) // columns
+        sheet = PIL.Image.new("RGBA", (columns * tile_w, rows * tile_h))
+        for d in range(directions):
+            dx = (d % 2) * tile_w
+            dy = (d // 2) * tile_h
+            for f, states in enumerate(frame_states):
+                i = d * len(frame_states) + f
+                tile = states[state].crop((dx, dy, dx + tile_w, dy + tile_h))
+                sheet.paste(tile, ((i % columns) * tile_w, (i // columns) * tile_h))
+        result[state] = sheet
+    return result
+
+def unsmooth(states, metrics, mode, engine=None):
+    # Inverse of smooth: rebuilds a source sheet from the output states, entirely in memory.
+    # states is anything indexable by state number (a smooth result, or a list of 8 images).
+    plan = inverse_plan(metrics, mode)
+    return execute_plan(plan, {i: states[i] for i in plan.src_sizes}, engine)[None]
+
+# PNG encoder settings for each --png-profile.
+# fast is for iterating on art, max for what gets committed; default is PIL's own.
+png_profiles = {
+    "fast": {"compress_level": 1},
+    "default": {},
+    "max": {"optimize": True},
+}
+
+def subtile_groups(states, plan):
+    # Groups every subtile a plan wrote into states by its pixels, in the order they were first written.
+    # Each group is a list of ((state, direction), (state, x, y, w, h)).
+    groups = {}
+    for (src_rect, dst_rect), label in zip(plan.blits, plan.labels):
+        dst_key, dx, dy, w, h = dst_rect
+        pixels = states[dst_key].crop((dx, dy, dx + w, dy + h)).tobytes()
+        digest = hashlib.sha256(str((w, h)).encode() + pixels).digest()
+        groups.setdefault(digest, []).append((label, dst_rect))
+    return list(groups.values())
+
+def subtile_atlas(states, plan):
+    # Packs each distinct subtile once into an atlas, and describes how to rebuild every state from it.
+    # Returns (atlas Image, layout) where layout is JSON-serializable.
+    groups = subtile_groups(states, plan)
+
+    # Simple shelf packing; every subtile fits in the width of the widest state.
+    width = max(size[0] for size in plan.dst_sizes.values())
+    x, y, shelf_h = 0, 0, 0
+    placements = []
+    for group in groups:
+        w, h = group[0][1][3:]
+        if x + w > width:
+            x, y, shelf_h = 0, y + shelf_h, 0
+        placements.append((x, y))
+        x += w
+        shelf_h = max(shelf_h, h)
+
+    atlas = PIL.Image.new("RGBA", (width, y + shelf_h))
+    layout = {
+        "subtiles": [],
+        "states": {str(key): {"size": list(size), "subtiles": []} for key, size in plan.dst_sizes.items()},
+    }
+    for index, (group, (ax, ay)) in enumerate(zip(groups, placements)):
+        dst_key, dx, dy, w, h = group[0][1]
+        atlas.paste(states[dst_key].crop((dx, dy, dx + w, dy + h)), (ax, ay))
+        layout["subtiles"].append({"x": ax, "y": ay, "w": w, "h": h})
+        for label, (dst_key, dx, dy, w, h) in group:
+            layout["states"][str(dst_key)]["subtiles"].append({"subtile": index, "x": dx, "y": dy})
+    return atlas, layout
+
+def save_pngs(images, profile="default"):
+    # Saves {file name: Image} with the given PNG profile.
+    # zlib releases the GIL, so encoding several images on threads actually runs them in parallel.
+    if profile not in png_profiles:
+        raise Exception("unknown PNG profile " + str(profile) + ", expected one of " + "/".join(png_profiles.keys()))
+    params = png_profiles[profile]
+    if len(images) == 1:
+        for name, img in images.items():
+            img.save(name, "PNG", **params)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(images)) as executor:
+        futures = [executor.submit(img.save, name, "PNG", **params) for name, img in images.items()]
+        for future in futures:
+            future.result()
+
+def save_states(states, out_prefix, profile="default"):
+    # Returns the names of the files written.
+    images = {out_prefix + str(state) + ".png": img for state, img in states.items()}
+    save_pngs(images, profile)
+    return list(images.keys())
+
+def save_animated_states(frame_states, delays, out_prefix, profile="default"):
+    # Like save_states, but writes every state as an animated PNG of its frames.
+    if profile not in png_profiles:
+        raise Exception("unknown PNG profile " + str(profile) + ", expected one of " + "/".join(png_profiles.keys()))
+    durations = [round(delay * 1000) for delay in delays]
+    written = []
+    for state in frame_states[0]:
+        name = out_prefix + str(state) + ".png"
+        frames = [states[state] for states in frame_states]
+        frames[0].save(name, "PNG", save_all=True, append_images=frames[1:], duration=durations, loop=0, **png_profiles[profile])
+        written.append(name)
+    return written
+
+def load_states(in_prefix):
+    return [PIL.Image.open(in_prefix + str(j) + ".png") for j in range(state_count)]
+
+def save_rsi(states, out_prefix, metrics, license=None, copyright=None, profile="default", delays=None):
+    # Writes the states straight into an RSI, along with its meta.json.
+    # For animations, states come from pack_frames and delays lists how long each frame is shown, in seconds.
+    # out_prefix is a path inside the .rsi directory, like explain_prefix; the rest of it prefixes the state names.
+    # An existing meta.json is updated in place, so states that weren't generated here are kept.
+    # Returns the names of the files written.
+    tile_w, tile_h = resolve_metrics(metrics)[:2]
+    rsi_dir, name_prefix = os.path.split(out_prefix)
+    if not rsi_dir.endswith(".rsi"):
+        raise Exception("RSI output needs an OUTPREFIX inside a .rsi directory, like " + explain_prefix)
+    os.makedirs(rsi_dir, exist_ok=True)
+
+    meta_name = os.path.join(rsi_dir, "meta.json")
+    if os.path.exists(meta_name):
+        with open(meta_name, "r", encoding="utf-8-sig") as f:
+            meta = json.load(f)
+        if meta["size"] != {"x": tile_w, "y": tile_h}:
+            raise Exception(meta_name + " is for " + str(meta["size"]["x"]) + "x" + str(meta["size"]["y"]) + " states, not " + str(tile_w) + "x" + str(tile_h))
+    else:
+        # There's no sensible default for either, and guessing could publish art under the wrong terms.
+        if license is None or copyright is None:
+            raise Exception("creating " + meta_name + " needs both --license and --copyright")
+        meta = {
+            "version": 1,
+            "license": license,
+            "copyright": copyright,
+            "size": {"x": tile_w, "y": tile_h},
+            "states": [],
+        }
+    if license is not None:
+        meta["license"] = license
+    if copyright is not None:
+        meta["copyright"] = copyright
+
+    images = {}
+    existing = {state["name"]: i for i, state in enumerate(meta["states"])}
+    for state, img in states.items():
+        name = name_prefix + str(state)
+        images[os.path.join(rsi_dir, name + ".png")] = img
+        # Numbered states are 2x2 sheets of the 4 directions; "full" is a single tile.
+        entry = {"name": name, "directions": 4} if state != "full" else {"name": name}
+        if delays is not None and len(delays) > 1:
+            entry["delays"] = [list(delays)] * entry.get("directions", 1)
+        if name in existing:
+            meta["states"][existing[name]] = entry
+        else:
+            existing[name] = len(meta["states"])
+            meta["states"].append(entry)
+
+    save_pngs(images, profile)
+    with open(meta_name, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=4)
+        f.write("\n")
+    return list(images.keys()) + [meta_name]
+
+# Bump this whenever a change to these tools changes what they write, so cached outputs get regenerated.
+tool_version = 1
+
+def file_sha256(name):
+    digest = hashlib.sha256()
+    with open(name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BuildCache:
+    # Persistent manifest of which outputs each job produced, and from what.
+    # A job is identified by where it writes to; its key covers everything its outputs depend on:
+    # the input bytes, METRICS, the conversion mode, any output options and tool_version.
+    # A job can be skipped if its key is unchanged and all its outputs still exist with the recorded hashes.
+    def __init__(self, name):
+        self.name = name
+        self.jobs = {}
+        if os.path.exists(name):
+            with open(name, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f).get("jobs", {})
+
+    @staticmethod
+    def job_key(input_names, metric_mode, conversion_mode, options=None):
+        digest = hashlib.sha256()
+        for input_name in input_names:
+            digest.update(file_sha256(input_name).encode())
+        digest.update(json.dumps([metric_mode, conversion_mode, options, tool_version], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def is_fresh(self, job, key):
+        entry = self.jobs.get(job)
+        if entry is None or entry["key"] != key:
+            return False
+        for output, output_hash in entry["outputs"].items():
+            if not os.path.exists(output) or file_sha256(output) != output_hash:
+                return False
+        return True
+
+    def record(self, job, key, outputs):
+        self.jobs[job] = {"key": key, "outputs": {output: file_sha256(output) for output in outputs}}
+
+    def save(self):
+        with open(self.name, "w", encoding="utf-8") as f:
+            json.dump({"tool_version": tool_version, "jobs": self.jobs}, f, indent=4, sort_keys=True)
+            f.write("\n")
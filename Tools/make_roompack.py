@@ -3,8 +3,13 @@
 # dungeon room pack configs.
 
 import argparse
-import cv2
-from dataclasses import dataclass
+import concurrent.futures
+import hashlib
+import json
+import numpy
+import os
+import sys
+from dataclasses import dataclass, field
 
 
 SUBDIVISIONS = 128
@@ -25,19 +30,43 @@ class RoomPackBitmap:
     width: int
     height: int
     rooms: list
+    # Where the bitmap's bottom left corner ends up once centered and offset.
+    origin_x: int = 0
+    origin_y: int = 0
+    # Pixel count of every bucket that has any pixels in it.
+    buckets: dict = field(default_factory=dict)
 
 
-def analyze_bitmap(fname, centered = False, offset_x = 0, offset_y = 0):
-    image = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+def bucket_range(i):
+    # Inclusive range of grey values that make up bucket i.
+    lower = MAX_VALUE / SUBDIVISIONS * (i - 1)
+    upper = MAX_VALUE / SUBDIVISIONS *  i - 1
+
+    lower = max(MIN_VALUE, lower)
+    upper = min(MAX_VALUE - 1, upper)
+    return lower, upper
 
-    contours = []
 
+def bucket_histogram(image):
+    # Counts the pixels in each bucket from a single histogram of the image, skipping empty buckets.
+    counts = numpy.bincount(image.ravel(), minlength=256)
+    buckets = {}
     for i in range(0, 1 + SUBDIVISIONS):
-        lower = MAX_VALUE / SUBDIVISIONS * (i - 1)
-        upper = MAX_VALUE / SUBDIVISIONS *  i - 1
+        lower, upper = bucket_range(i)
+        pixels = int(counts[int(numpy.ceil(max(lower, 0))):int(upper) + 1].sum())
+        if pixels > 0:
+            buckets[i] = pixels
+    return buckets
+
+
+def find_rects_contours(image, buckets):
+    # Thresholds the image once per occupied bucket and traces the contours of each slice.
+    import cv2
+
+    contours = []
 
-        lower = max(MIN_VALUE, lower)
-        upper = min(MAX_VALUE - 1, upper)
+    for i in buckets:
+        lower, upper = bucket_range(i)
 
         image_slice = cv2.inRange(image, lower, upper)
         image_mask = cv2.threshold(image_slice, 0, 255, cv2.THRESH_TOZERO)[1]
@@ -48,33 +77,651 @@ def analyze_bitmap(fname, centered = False, offset_x = 0, offset_y = 0):
 
         contours += new_contours[0:-1]
 
-    image_height = len(image)
-    image_width = len(image[0])
+    rects = []
+    for contour in contours:
+        for subcontour in contour:
+            rects.append(cv2.boundingRect(subcontour))
+
+    return rects
+
+
+def bucket_keys(image):
+    # Maps every pixel to 1 + the bucket it falls in, or 0 if it's in none.
+    # MAX_VALUE is a multiple of SUBDIVISIONS, so the buckets never overlap.
+    lut = numpy.zeros(256, dtype=numpy.uint8 if SUBDIVISIONS < 255 else numpy.uint16)
+    values = numpy.arange(256)
+    for i in range(0, 1 + SUBDIVISIONS):
+        lower, upper = bucket_range(i)
+        lut[(values >= lower) & (values <= upper)] = i + 1
+    return lut[image]
+
+
+def label_runs(keys, diagonal):
+    # Connected components of equal, non-zero keys, 8-connected if diagonal else 4-connected.
+    # Works on horizontal runs of equal keys rather than pixels: runs are unioned with the runs they overlap
+    # in the row above, found by binary search over the runs in raster order, so the only per-pixel work
+    # is a single comparison of each pixel with its left neighbour.
+    height, width = keys.shape
+    flat = keys.ravel()
+    # Every row starts a new segment, so segments never wrap from one row into the next.
+    changes = numpy.empty(keys.shape, dtype=bool)
+    changes[:, 0] = True
+    numpy.not_equal(keys[:, 1:], keys[:, :-1], out=changes[:, 1:])
+    segment_starts = numpy.flatnonzero(changes)
+    del changes
+    segment_ends = numpy.append(segment_starts[1:], flat.size) - 1
+    nonzero = flat[segment_starts] != 0
+    run_starts = segment_starts[nonzero]
+    run_ends = segment_ends[nonzero]
+    run_key = flat[run_starts].astype(numpy.int64)
+    run_y, run_x0 = numpy.divmod(run_starts, width)
+    run_x1 = run_ends - run_y * width
+    run_count = len(run_y)
+
+    # Pairs of runs of the same key in neighbouring rows that touch: for each run, the runs of the row above
+    # that end at or after its left edge and start at or before its right edge, widened a pixel for diagonals.
+    reach = 1 if diagonal else 0
+    above = (run_y - 1) * width
+    first = numpy.searchsorted(run_ends, above + numpy.maximum(run_x0 - reach, 0), side="left")
+    last = numpy.searchsorted(run_starts, above + numpy.minimum(run_x1 + reach, width - 1), side="right")
+    counts = last - first
+    touch_b = numpy.repeat(numpy.arange(run_count), counts)
+    touch_a = numpy.repeat(first - numpy.cumsum(counts) + counts, counts) + numpy.arange(len(touch_b))
+    same = run_key[touch_a] == run_key[touch_b]
+    touch_a = touch_a[same]
+    touch_b = touch_b[same]
+
+    # Union-find, always hooking onto the lower run id, so each component ends up rooted at its first run.
+    parent = numpy.arange(run_count)
+    while True:
+        while True:
+            grandparent = parent[parent]
+            if numpy.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        root_a = parent[touch_a]
+        root_b = parent[touch_b]
+        differ = root_a != root_b
+        if not differ.any():
+            break
+        numpy.minimum.at(parent, numpy.maximum(root_a[differ], root_b[differ]), numpy.minimum(root_a[differ], root_b[differ]))
+
+    roots, component = numpy.unique(parent, return_inverse=True)
+    component_count = len(roots)
+
+    left = numpy.full(component_count, width, dtype=numpy.int64)
+    numpy.minimum.at(left, component, run_x0)
+    right = numpy.zeros(component_count, dtype=numpy.int64)
+    numpy.maximum.at(right, component, run_x1)
+    bottom = numpy.zeros(component_count, dtype=numpy.int64)
+    numpy.maximum.at(bottom, component, run_y)
+
+    return component, run_y, {
+        # First pixel of each component in raster order, which is where a contour trace would start.
+        "start_x": run_x0[roots],
+        "start_y": run_y[roots],
+        "left": left,
+        "right": right,
+        "bottom": bottom,
+        "runs": numpy.bincount(component, minlength=component_count),
+        "pairs": numpy.bincount(component[touch_a], minlength=component_count),
+        "key": run_key[roots],
+    }
+
+
+class RunLabeler:
+    # label_runs over an image fed in strips from the top down. The last row of each strip is kept and
+    # labelled again on top of the next one, and components that meet across that seam are merged,
+    # so only one strip is ever held no matter how tall the image is.
+    def __init__(self, diagonal):
+        self.diagonal = diagonal
+        self.components = None
+        self.parent = numpy.zeros(0, dtype=numpy.int64)
+        self.seam_keys = None
+        self.seam_ids = None
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def merge(self, a, b):
+        if a == b:
+            return a
+        keep, drop = min(a, b), max(a, b)
+        self.parent[drop] = keep
+        c = self.components
+        if (c["start_y"][drop], c["start_x"][drop]) < (c["start_y"][keep], c["start_x"][keep]):
+            c["start_x"][keep] = c["start_x"][drop]
+            c["start_y"][keep] = c["start_y"][drop]
+        c["left"][keep] = min(c["left"][keep], c["left"][drop])
+        c["right"][keep] = max(c["right"][keep], c["right"][drop])
+        c["bottom"][keep] = max(c["bottom"][keep], c["bottom"][drop])
+        c["runs"][keep] += c["runs"][drop]
+        c["pairs"][keep] += c["pairs"][drop]
+        return keep
+
+    def feed(self, y, keys):
+        if self.seam_keys is not None:
+            keys = numpy.concatenate([self.seam_keys, keys])
+            y -= 1
+        component, run_y, local = label_runs(keys, self.diagonal)
+        local["start_y"] += y
+        local["bottom"] += y
+
+        ids = numpy.full(len(local["key"]), -1, dtype=numpy.int64)
+        if self.seam_keys is not None:
+            # The seam row's runs were counted with the last strip; the pairs across it weren't.
+            seam = component[:len(self.seam_ids)]
+            local["runs"] -= numpy.bincount(seam, minlength=len(ids))
+            for c, old in zip(seam.tolist(), self.seam_ids.tolist()):
+                old = self.find(old)
+                ids[c] = old if ids[c] < 0 else self.merge(self.find(ids[c]), old)
+            continued = numpy.nonzero(ids >= 0)[0]
+            targets = numpy.array([self.find(i) for i in ids[continued]], dtype=numpy.int64)
+            numpy.minimum.at(self.components["left"], targets, local["left"][continued])
+            numpy.maximum.at(self.components["right"], targets, local["right"][continued])
+            numpy.maximum.at(self.components["bottom"], targets, local["bottom"][continued])
+            numpy.add.at(self.components["runs"], targets, local["runs"][continued])
+            numpy.add.at(self.components["pairs"], targets, local["pairs"][continued])
+
+        new = numpy.nonzero(ids < 0)[0]
+        ids[new] = len(self.parent) + numpy.arange(len(new))
+        self.parent = numpy.concatenate([self.parent, ids[new]])
+        if self.components is None:
+            self.components = {name: values[new] for name, values in local.items()}
+        else:
+            for name, values in local.items():
+                self.components[name] = numpy.concatenate([self.components[name], values[new]])
+
+        self.seam_keys = keys[-1:].copy()
+        last_runs = component[run_y == len(keys) - 1]
+        self.seam_ids = numpy.array([self.find(i) for i in ids[last_runs]], dtype=numpy.int64)
+
+    def finish(self):
+        roots = numpy.nonzero(self.parent == numpy.arange(len(self.parent)))[0]
+        result = {name: values[roots] for name, values in self.components.items()} if self.components is not None else \
+                 {name: numpy.zeros(0, dtype=numpy.int64) for name in ["start_x", "start_y", "left", "right", "bottom", "runs", "pairs", "key"]}
+        result["top"] = result["start_y"]
+        # Runs of an 8-connected set touch like a forest, so its Euler number is runs - touching pairs,
+        # and it has 1 - that many holes.
+        result["holes"] = 1 - (result["runs"] - result["pairs"])
+        return result
+
+
+def find_rects_strips(read_strips, buckets = None):
+    # Same rectangles, in the same order, as find_rects_contours, from one labelling pass over all buckets.
+    # read_strips() yields (y, rows) from the top of the bitmap down; it's called a second time if there are holes.
+    return find_rects_keys(lambda: ((y, bucket_keys(rows)) for y, rows in read_strips()), buckets)
+
+
+def find_rects_keys(read_keys, buckets = None):
+    # find_rects_strips on bitmaps already put through bucket_keys: read_keys() yields (y, keys) strips.
+    # findContours(RETR_LIST) reports every outer border and every hole border of a slice, newest first;
+    # an outer border bounds its component, and a hole border bounds the pixels around the hole.
+    labeler = RunLabeler(True)
+    width = 0
+    for y, keys in read_keys():
+        labeler.feed(y, keys)
+        width = keys.shape[1]
+        if buckets is not None:
+            for key, pixels in enumerate(numpy.bincount(keys.ravel()).tolist()):
+                if key > 0 and pixels > 0:
+                    buckets[key - 1] = buckets.get(key - 1, 0) + pixels
+    components = labeler.finish()
+
+    found = []
+    for i in range(len(components["key"])):
+        left = int(components["left"][i])
+        top = int(components["top"][i])
+        found.append((int(components["key"][i]),
+                      int(components["start_y"][i]) * width + int(components["start_x"][i]),
+                      (left, top, int(components["right"][i]) - left + 1, int(components["bottom"][i]) - top + 1)))
+
+    # Holes are rare, so they're only looked for around components whose Euler number says they have some.
+    # Within the bounding box of those, the holes are the 4-connected areas outside the bucket that don't reach the edge.
+    windows = {}
+    with_holes = components["holes"] > 0
+    for key in numpy.unique(components["key"][with_holes]).tolist():
+        selected = with_holes & (components["key"] == key)
+        windows[key] = (int(components["left"][selected].min()),
+                        int(components["top"][selected].min()),
+                        int(components["right"][selected].max()),
+                        int(components["bottom"][selected].max()),
+                        RunLabeler(False))
+
+    if windows:
+        for y, keys in read_keys():
+            for key, (x0, y0, x1, y1, hole_labeler) in windows.items():
+                top = max(y, y0)
+                bottom = min(y + len(keys) - 1, y1)
+                if top <= bottom:
+                    hole_labeler.feed(top, (keys[top - y:bottom - y + 1, x0:x1 + 1] != key).astype(numpy.uint8))
+
+    for key, (x0, y0, x1, y1, hole_labeler) in windows.items():
+        holes = hole_labeler.finish()
+        for j in range(len(holes["key"])):
+            left = int(holes["left"][j])
+            top = int(holes["top"][j])
+            right = int(holes["right"][j])
+            bottom = int(holes["bottom"][j])
+            if left == 0 or top == y0 or right == x1 - x0 or bottom == y1:
+                continue
+            # The border of a hole is traced from the pixel just left of its first pixel.
+            start = int(holes["start_y"][j]) * width + int(holes["start_x"][j]) + x0 - 1
+            found.append((key, start, (left + x0 - 1, top - 1, right - left + 3, bottom - top + 3)))
+
+    found.sort(key=lambda f: (f[0], -f[1]))
+    return [rect for key, start, rect in found]
+
+
+def find_rects_labels(image, buckets):
+    return find_rects_strips(lambda: [(0, image)])
+
+
+ENGINES = {
+    "labels": find_rects_labels,
+    "contours": find_rects_contours,
+}
+
+
+# Fixed point weights of red, green and blue that cv2.IMREAD_GRAYSCALE greys colour with, their scale and rounding:
+# libpng's, truncated, for 8 bit PNGs, and OpenCV's own, rounded, for the formats it decodes itself.
+PNG_GREY_WEIGHTS = (9797, 19234, 3737), 15, 0
+OPENCV_GREY_WEIGHTS = (4899, 9617, 1868), 14, 1 << 13
+
+
+def weigh_grey(channels, weights):
+    (red, green, blue), shift, rounding = weights
+    grey = channels[..., 0].astype(numpy.uint32) * red
+    grey += channels[..., 1].astype(numpy.uint32) * green
+    grey += channels[..., 2].astype(numpy.uint32) * blue
+    grey += rounding
+    return grey >> shift
+
+
+def grey_pixels(image, weights):
+    # A PIL image as the uint8 pixels cv2.IMREAD_GRAYSCALE would give for it: 16 bit grey keeps its high byte,
+    # alpha is ignored, and palette and colour images are weighted down to grey.
+    if image.mode in ("I;16", "I;16B", "I"):
+        return (numpy.asarray(image) >> 8).astype(numpy.uint8)
+    if image.mode in ("1", "L", "LA"):
+        return numpy.asarray(image.convert("L"))
+    return weigh_grey(numpy.asarray(image.convert("RGB")), weights).astype(numpy.uint8)
+
+
+def load_png_16_colour(fname, width, height, colour_type):
+    # Pillow keeps only the high byte of 16 bit colour samples, but libpng greys them at full depth and rounds
+    # before OpenCV drops the low byte. The image data is decoded twice, once per byte, to get them all back.
+    from PIL import Image
+    import png_strips
+
+    mode = "RGB" if colour_type == 2 else "RGBA"
+    with open(fname, "rb") as f:
+        data = b"".join(png_strips.png_data(f))
+    high, low = [numpy.asarray(Image.frombytes(mode, (width, height), data, "zip", mode + ";16" + order)) for order in "BL"]
+    channels = high.astype(numpy.uint32) << 8 | low
+    return (weigh_grey(channels, (PNG_GREY_WEIGHTS[0], 15, 1 << 14)) >> 8).astype(numpy.uint8)
+
+
+def load_bitmap_numpy(fname):
+    from PIL import Image
+    import png_strips
+
+    ihdr = png_strips.png_ihdr(fname)
+    if ihdr is not None and ihdr[2] == 16 and ihdr[3] in (2, 6) and ihdr[4] == 0:
+        return load_png_16_colour(fname, ihdr[0], ihdr[1], ihdr[3])
+
+    with Image.open(fname) as image:
+        if image.format == "JPEG":
+            # libjpeg hands back its own luma, as it does for OpenCV.
+            image.draft("L", image.size)
+        return grey_pixels(image, PNG_GREY_WEIGHTS if ihdr is not None else OPENCV_GREY_WEIGHTS)
+
+
+def load_bitmap_cv2(fname):
+    import cv2
+
+    return cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+
+
+def read_strips_numpy(fname, strip_height = None):
+    # PNGs png_strips can decode are read a strip at a time; anything else is loaded whole and then cut up.
+    # Without a strip_height, strips are about a megabyte each.
+    import png_strips
+
+    if png_strips.png_header(fname) is None:
+        image = load_bitmap_numpy(fname)
+        strip_height = strip_height or png_strips.default_strip_height(image.shape[1], "L")
+        for y in range(0, len(image), strip_height):
+            yield y, image[y:y + strip_height]
+        return
+
+    for y, strip in png_strips.read_png_strips(fname, strip_height):
+        yield y, grey_pixels(strip, PNG_GREY_WEIGHTS)
+
+
+def read_strips_cv2(fname, strip_height = None):
+    # OpenCV can't decode part of an image, so this only bounds the memory used by labelling.
+    import png_strips
+
+    image = load_bitmap_cv2(fname)
+    strip_height = strip_height or png_strips.default_strip_height(image.shape[1], "L")
+    for y in range(0, len(image), strip_height):
+        yield y, image[y:y + strip_height]
+
+
+# Only the backend asked for gets imported, so the default needs neither OpenCV nor its startup time.
+# The two decode bitmaps identically, colour ones included, apart from lossy formats like WebP whose decoders differ.
+BACKENDS = {
+    "numpy": (load_bitmap_numpy, read_strips_numpy),
+    "cv2": (load_bitmap_cv2, read_strips_cv2),
+}
+
+
+def rects_to_rooms(rects, offset_x, offset_y):
     rooms = []
 
+    for x, y, w, h in rects:
+        box = Box2(offset_x + x,
+                   offset_y + y,
+                   offset_x + x + w,
+                   offset_y + y + h)
+
+        rooms.append(box)
+
+    return rooms
+
+
+def analyze_bitmap(fname, centered = False, offset_x = 0, offset_y = 0, engine = "labels", backend = "numpy", tile = None):
+    if tile and engine != "labels":
+        raise ValueError("tiled analysis needs the labels engine")
+    if engine == "labels":
+        # The bitmap is read and labelled tile rows at a time, about a megabyte of them unless asked otherwise,
+        # so memory doesn't grow with its height. It's no slower than labelling it whole.
+        size = [0, 0]
+        def read_strips():
+            for y, rows in BACKENDS[backend][1](fname, tile):
+                size[0] = rows.shape[1]
+                size[1] = y + len(rows)
+                yield y, rows
+        buckets = {}
+        rects = find_rects_strips(read_strips, buckets)
+        buckets = dict(sorted(buckets.items()))
+        image_width, image_height = size
+    else:
+        image = BACKENDS[backend][0](fname)
+
+        buckets = bucket_histogram(image)
+        rects = ENGINES[engine](image, buckets)
+
+        image_height = len(image)
+        image_width = len(image[0])
+
     if centered:
         offset_x -= image_width // 2
         offset_y -= image_height // 2
 
-    for contour in contours:
-        for subcontour in contour:
-            x, y, w, h = cv2.boundingRect(subcontour)
+    rooms = rects_to_rooms(rects, offset_x, offset_y)
+
+    return RoomPackBitmap(image_width, image_height, rooms, offset_x, offset_y, buckets)
+
+
+def room_relation(a, b):
+    # How two rooms collide: "nested", "overlapping", "touching" (sharing a stretch of wall), or None.
+    x0 = max(a.left, b.left)
+    x1 = min(a.right, b.right)
+    y0 = max(a.bottom, b.bottom)
+    y1 = min(a.top, b.top)
+
+    if x0 < x1 and y0 < y1:
+        if (x0, y0, x1, y1) in ((a.left, a.bottom, a.right, a.top), (b.left, b.bottom, b.right, b.top)):
+            return "nested"
+        return "overlapping"
+
+    if x0 <= x1 and y0 <= y1 and (x0 < x1 or y0 < y1):
+        return "touching"
+
+    return None
+
+
+class SpanIndex:
+    # The active rooms' [bottom, top] spans, over the sorted distinct y values they use.
+    # Closed spans meet iff the higher of the two bottoms lies in both, so a query finds each room
+    # once: either its bottom is above the query's bottom and within the query, or its span contains
+    # the query's bottom. The first part is a count tree over bottoms, skipping empty ranges; the second
+    # is a segment tree whose nodes hold the spans that cover them.
+    def __init__(self, ys):
+        self.index = {y: n for n, y in enumerate(ys)}
+        self.size = 1
+        while self.size < len(ys):
+            self.size *= 2
+        self.counts = [0] * (2 * self.size)
+        self.bottoms = [set() for _ in range(self.size)]
+        self.covers = [set() for _ in range(2 * self.size)]
+
+    def _canonical_nodes(self, lo, hi):
+        lo += self.size
+        hi += self.size + 1
+        while lo < hi:
+            if lo & 1:
+                yield lo
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                yield hi
+            lo //= 2
+            hi //= 2
+
+    def _update(self, i, bottom, top, add):
+        lo = self.index[bottom]
+        hi = self.index[top]
+        (self.bottoms[lo].add if add else self.bottoms[lo].discard)(i)
+        node = lo + self.size
+        while node:
+            self.counts[node] += 1 if add else -1
+            node //= 2
+        for node in self._canonical_nodes(lo, hi):
+            (self.covers[node].add if add else self.covers[node].discard)(i)
+
+    def add(self, i, bottom, top):
+        self._update(i, bottom, top, True)
+
+    def remove(self, i, bottom, top):
+        self._update(i, bottom, top, False)
+
+    def overlapping(self, bottom, top):
+        lo = self.index[bottom]
+        hi = self.index[top]
+        node = lo + self.size
+        while node:
+            yield from self.covers[node]
+            node //= 2
+        if lo == hi:
+            return
+        stack = [(1, 0, self.size - 1)]
+        while stack:
+            node, node_lo, node_hi = stack.pop()
+            if self.counts[node] == 0 or node_hi <= lo or node_lo > hi:
+                continue
+            if node >= self.size:
+                yield from self.bottoms[node_lo]
+                continue
+            middle = (node_lo + node_hi) // 2
+            stack.append((2 * node + 1, middle + 1, node_hi))
+            stack.append((2 * node, node_lo, middle))
+
+
+def validate_rooms(result):
+    # Finds rooms that fall outside the bitmap or collide with each other, as (problem, room, other room or None).
+    # A line sweeps left to right over the rooms' left and right edges. Each room is checked against the rooms
+    # the line is currently inside whose y spans meet its own, so this is O(n log n) plus the pairs that touch.
+    problems = []
+    rooms = result.rooms
+
+    for i, room in enumerate(rooms):
+        if room.left < result.origin_x or room.bottom < result.origin_y or \
+           room.right > result.origin_x + result.width or room.top > result.origin_y + result.height:
+            problems.append(("out of bounds", i, None))
+
+    # Rooms are added before any are removed at the same x, so rooms that only share a vertical wall still meet.
+    events = sorted([(room.left, 0, i) for i, room in enumerate(rooms)] + [(room.right, 1, i) for i, room in enumerate(rooms)])
+    active = SpanIndex(sorted({y for room in rooms for y in (room.bottom, room.top)}))
+    for x, removed, i in events:
+        a = rooms[i]
+        if removed:
+            active.remove(i, a.bottom, a.top)
+            continue
+        for j in active.overlapping(a.bottom, a.top):
+            # Rooms that only share a corner meet here too; room_relation sorts those out.
+            relation = room_relation(a, rooms[j])
+            if relation is not None:
+                problems.append((relation, min(i, j), max(i, j)))
+        active.add(i, a.bottom, a.top)
+
+    problems.sort(key=lambda p: (p[1], -1 if p[2] is None else p[2]))
+    return problems
+
+
+def format_problems(result, problems):
+    lines = []
+    for relation, i, j in problems:
+        a = result.rooms[i]
+        line = f"Room {i} ({a.left},{a.bottom},{a.right},{a.top}) is {relation}"
+        if j is not None:
+            b = result.rooms[j]
+            line += f" with room {j} ({b.left},{b.bottom},{b.right},{b.top})"
+        lines.append(line)
+    return lines
+
+
+def format_room_pack(result):
+    # The size and rooms lines of a dungeonRoomPack prototype.
+    lines = [f"  size: {result.width},{result.height}", "  rooms:"]
+    for room in result.rooms:
+        lines.append(f"    - {room.left},{room.bottom},{room.right},{room.top}")
+    return lines
+
+
+def update_room_packs(text, packs):
+    # Rewrites the size and rooms of each dungeonRoomPack in packs (id -> RoomPackBitmap) in the YAML text,
+    # appending the ones that aren't there yet. Works on lines so comments and other fields are kept.
+    lines = text.splitlines()
+    output = []
+    remaining = dict(packs)
+
+    i = 0
+    while i < len(lines):
+        if lines[i].rstrip() != "- type: dungeonRoomPack":
+            output.append(lines[i])
+            i += 1
+            continue
 
-            box = Box2(offset_x + x,
-                       offset_y + y,
-                       offset_x + x + w,
-                       offset_y + y + h)
+        end = i + 1
+        while end < len(lines) and lines[end].startswith(" "):
+            end += 1
+        entry = lines[i:end]
+        i = end
 
-            rooms.append(box)
+        ids = [line.split(":", 1)[1].strip() for line in entry if line.startswith("  id:")]
+        if not ids or ids[0] not in remaining:
+            output += entry
+            continue
 
-    return RoomPackBitmap(image_width, image_height, rooms)
+        generated = format_room_pack(remaining.pop(ids[0]))
+        in_rooms = False
+        for line in entry:
+            if line.startswith("  size:") or line.startswith("  rooms:"):
+                in_rooms = line.startswith("  rooms:")
+                continue
+            if in_rooms and line.startswith("    "):
+                continue
+            in_rooms = False
+            output.append(line)
+            if line.startswith("  id:"):
+                output += generated
+
+    for pack_id, result in remaining.items():
+        if output and output[-1].strip() != "":
+            output.append("")
+        output += ["- type: dungeonRoomPack", f"  id: {pack_id}"] + format_room_pack(result)
+
+    return "\n".join(output) + "\n"
+
+
+def file_hash(fname, options):
+    # Changes whenever the bitmap or the options it's analyzed with do.
+    digest = hashlib.sha256(json.dumps(options).encode())
+    with open(fname, "rb") as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+def run_batch(directory, yaml_name, manifest_name, jobs, centered, offset_x, offset_y, engine, backend, tile = None, validate = False):
+    # Analyzes every bitmap in directory in parallel and writes each one to yaml_name as the room pack
+    # named after the bitmap. Bitmaps whose hash matches the manifest, and whose pack is already there, are skipped,
+    # unless validating and they weren't validated when last analyzed. Packs that fail validation are written
+    # but left out of the manifest, so they're analyzed and fail again until the bitmap is fixed.
+    options = [centered, offset_x, offset_y]
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith((".png", ".bmp")))
+
+    manifest = {}
+    if os.path.exists(manifest_name):
+        with open(manifest_name) as f:
+            manifest = json.load(f)
+
+    text = ""
+    if os.path.exists(yaml_name):
+        with open(yaml_name) as f:
+            text = f.read()
+    existing = set(line.split(":", 1)[1].strip() for line in text.splitlines() if line.startswith("  id:"))
+
+    hashes = {}
+    stale = []
+    for name in names:
+        pack_id = os.path.splitext(name)[0]
+        hashes[pack_id] = file_hash(os.path.join(directory, name), options)
+        entry = manifest.get(pack_id, {})
+        if entry.get("hash") != hashes[pack_id] or pack_id not in existing or (validate and not entry.get("validated")):
+            stale.append((pack_id, name))
+
+    packs = {}
+    invalid = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {pack_id: executor.submit(analyze_bitmap, os.path.join(directory, name), centered, offset_x, offset_y, engine, backend, tile)
+                   for pack_id, name in stale}
+        for pack_id, future in futures.items():
+            packs[pack_id] = future.result()
+            print(f"{pack_id}: {len(packs[pack_id].rooms)} rooms")
+            manifest[pack_id] = {"hash": hashes[pack_id], "validated": validate}
+            if validate:
+                problems = validate_rooms(packs[pack_id])
+                if problems:
+                    invalid += 1
+                    del manifest[pack_id]
+                for line in format_problems(packs[pack_id], problems):
+                    print(f"  {line}")
+
+    if packs:
+        with open(yaml_name, "w") as f:
+            f.write(update_room_packs(text, packs))
+
+    with open(manifest_name, "w") as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+        f.write("\n")
+
+    print(f"Updated {len(packs)} room packs, {len(names) - len(packs)} unchanged.")
+    if validate:
+        print(f"{invalid} room packs have invalid rooms.")
+    return invalid == 0
 
 
 def main():
     parser = argparse.ArgumentParser(description='Calculate rooms from a greyscale bitmap')
 
     parser.add_argument('file', type=str,
-                        help='a greyscale bitmap')
+                        help='a greyscale bitmap, or with --batch a directory of them')
 
     parser.add_argument('--center', action=argparse.BooleanOptionalAction,
                         default=False,
@@ -85,20 +732,74 @@ def main():
                         default=[0, 0],
                         help='offset the output coordinates')
 
+    parser.add_argument('--engine', choices=list(ENGINES.keys()),
+                        default='labels',
+                        help='labels scans the image once; contours thresholds it once per bucket and needs cv2')
+
+    parser.add_argument('--backend', choices=list(BACKENDS.keys()),
+                        default='numpy',
+                        help='library used to decode the bitmap')
+
+    parser.add_argument('--stats', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='report how many pixels fall in each bucket')
+
+    parser.add_argument('--tile', type=int,
+                        metavar='ROWS',
+                        help='read and label the bitmap this many rows at a time (labels engine only, default about 1MB of rows)')
+
+    parser.add_argument('--batch', type=str,
+                        metavar='YAML',
+                        help='write a room pack per bitmap in the directory into this prototype file')
+
+    parser.add_argument('--manifest', type=str,
+                        help='hashes of the bitmaps already in the prototype file, and whether they were validated; required with --batch, '
+                             'and best kept out of Resources/ since it is a build artifact')
+
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=None,
+                        help='number of bitmaps to analyze at once in batch mode')
+
+    parser.add_argument('--validate', action=argparse.BooleanOptionalAction,
+                        default=False,
+                        help='report rooms that overlap, touch, nest or leave the bitmap, and fail if there are any')
+
     args = parser.parse_args()
 
-    result = analyze_bitmap(args.file, args.center, args.offset[0], args.offset[1])
+    if args.tile is not None and (args.tile < 1 or args.engine != 'labels'):
+        parser.error('--tile needs a positive number of rows and the labels engine')
 
+    if args.batch and not args.manifest:
+        parser.error('--batch needs --manifest, somewhere outside the prototype tree')
 
-    print(f"  size: {result.width},{result.height}")
-    print("  rooms:")
+    if args.batch:
+        if not run_batch(args.file, args.batch, args.manifest, args.jobs, args.center, args.offset[0], args.offset[1], args.engine, args.backend, args.tile, args.validate):
+            sys.exit(1)
+        return
+
+    result = analyze_bitmap(args.file, args.center, args.offset[0], args.offset[1], args.engine, args.backend, args.tile)
 
-    for room in result.rooms:
-        print(f"    - {room.left},{room.bottom},{room.right},{room.top}")
+
+    for line in format_room_pack(result):
+        print(line)
 
     print("")
     print(f"Generated {len(result.rooms)} rooms.")
 
+    if args.stats:
+        total = result.width * result.height
+        print(f"{len(result.buckets)} of {1 + SUBDIVISIONS} buckets occupied.")
+        for i, pixels in result.buckets.items():
+            lower, upper = bucket_range(i)
+            print(f"  bucket {i} ({int(lower)}-{int(upper)}): {pixels} pixels, {100 * pixels / total:.1f}%")
+
+    if args.validate:
+        problems = validate_rooms(result)
+        for line in format_problems(result, problems):
+            print(line)
+        if problems:
+            sys.exit(1)
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# Times make_roompack on synthetic dungeon bitmaps, per backend, engine and stage,
+# and prints the results as JSON so runs can be compared between commits.
+
+import argparse
+import importlib.util
+import json
+import numpy
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import make_roompack
+
+
+def synthetic_bitmap(width, height, rooms, levels, holes = 0.1, seed = 0):
+    # Random rectangular rooms, each a grey level picked from `levels` evenly spread ones and kept at least
+    # a pixel away from the others. A `holes` fraction of them get a pillar of black in the middle.
+    rng = random.Random(seed)
+    greys = [1 + (254 * i) // max(1, levels - 1) for i in range(levels)]
+    image = numpy.zeros((height, width), dtype=numpy.uint8)
+    taken = numpy.zeros((height, width), dtype=bool)
+    largest = max(3, int((width * height / max(1, rooms)) ** 0.5))
+
+    placed = 0
+    for _ in range(rooms * 20):
+        if placed == rooms:
+            break
+        w = rng.randint(2, min(largest, width))
+        h = rng.randint(2, min(largest, height))
+        x = rng.randint(0, width - w)
+        y = rng.randint(0, height - h)
+        if taken[max(0, y - 1):y + h + 1, max(0, x - 1):x + w + 1].any():
+            continue
+        taken[y:y + h, x:x + w] = True
+        image[y:y + h, x:x + w] = rng.choice(greys)
+        if w >= 5 and h >= 5 and rng.random() < holes:
+            image[y + h // 3:y + 2 * h // 3, x + w // 3:x + 2 * w // 3] = 0
+        placed += 1
+
+    return image, placed
+
+
+def time_call(fn, iterations):
+    # Best of N, in milliseconds, and the result of the last run.
+    best = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000, result
+
+
+def available_backends():
+    # cv2 is optional; without it only the numpy backend and labels engine can run.
+    if importlib.util.find_spec("cv2") is None:
+        return ["numpy"]
+    return ["numpy", "cv2"]
+
+
+def bench(fname, backend, engine, iterations, tile):
+    decode_ms, image = time_call(lambda: make_roompack.BACKENDS[backend][0](fname), iterations)
+    bucketing_ms, buckets = time_call(lambda: make_roompack.bucket_histogram(image), iterations)
+    if engine == "labels":
+        # The labels engine buckets every pixel itself; time that here, once, and label the precomputed keys.
+        keys_ms, keys = time_call(lambda: make_roompack.bucket_keys(image), iterations)
+        bucketing_ms += keys_ms
+        labeling_ms, rects = time_call(lambda: make_roompack.find_rects_keys(lambda: [(0, keys)]), iterations)
+    else:
+        labeling_ms, rects = time_call(lambda: make_roompack.ENGINES[engine](image, buckets), iterations)
+    emission_ms, rooms = time_call(lambda: make_roompack.rects_to_rooms(rects, 0, 0), iterations)
+    total_ms, result = time_call(lambda: make_roompack.analyze_bitmap(fname, engine=engine, backend=backend), iterations)
+
+    timings = {
+        "backend": backend,
+        "engine": engine,
+        "rooms": len(result.rooms),
+        "buckets": len(result.buckets),
+        "decode_ms": decode_ms,
+        "bucketing_ms": bucketing_ms,
+        "labeling_ms": labeling_ms,
+        "emission_ms": emission_ms,
+        "total_ms": total_ms,
+    }
+
+    if tile and engine == "labels":
+        tiled_ms, tiled = time_call(lambda: make_roompack.analyze_bitmap(fname, engine=engine, backend=backend, tile=tile), iterations)
+        timings["tiled_ms"] = tiled_ms
+        timings["tiled_matches"] = tiled == result
+
+    return timings, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark make_roompack on synthetic bitmaps')
+
+    parser.add_argument('--size', type=int,
+                        nargs=2,
+                        default=[2048, 2048],
+                        help='width and height of the bitmap')
+
+    parser.add_argument('--rooms', type=int,
+                        default=500,
+                        help='number of rooms to try to place')
+
+    parser.add_argument('--levels', type=int,
+                        default=32,
+                        help='number of distinct grey levels the rooms use')
+
+    parser.add_argument('--holes', type=float,
+                        default=0.1,
+                        help='fraction of rooms with a hole in them')
+
+    parser.add_argument('--seed', type=int,
+                        default=0)
+
+    parser.add_argument('--iterations', type=int,
+                        default=5,
+                        help='runs per measurement; the best one is reported')
+
+    parser.add_argument('--tile', type=int,
+                        metavar='ROWS',
+                        help='also time tiled analysis with this many rows per strip')
+
+    parser.add_argument('--output', type=str,
+                        help='write the JSON here instead of to stdout')
+
+    args = parser.parse_args()
+
+    image, placed = synthetic_bitmap(args.size[0], args.size[1], args.rooms, args.levels, args.holes, args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        fname = os.path.join(directory, "bitmap.png")
+        from PIL import Image
+        Image.fromarray(image).save(fname)
+
+        runs = []
+        reference = None
+        for backend in available_backends():
+            for engine in (["labels", "contours"] if backend == "cv2" else ["labels"]):
+                timings, result = bench(fname, backend, engine, args.iterations, args.tile)
+                timings["matches"] = reference is None or result == reference
+                reference = reference or result
+                runs.append(timings)
+
+    report = {
+        "bitmap": {
+            "width": args.size[0],
+            "height": args.size[1],
+            "rooms": placed,
+            "levels": args.levels,
+            "holes": args.holes,
+            "seed": args.seed,
+        },
+        "iterations": args.iterations,
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "runs": runs,
+    }
+
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if not all(run["matches"] and run.get("tiled_matches", True) for run in runs):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
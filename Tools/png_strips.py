@@ -0,0 +1,90 @@
+# Decodes PNGs a strip of rows at a time, so tools working on huge images never hold all of them.
+# Shared by make_roompack.py and iconsmooth_lib.py.
+
+import PIL.Image
+import os
+import struct
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PIL modes of the 8 bit colour types, which are also the raw modes their rows are stored in.
+PNG_MODES = {0: "L", 2: "RGB", 3: "P", 4: "LA", 6: "RGBA"}
+
+
+def png_ihdr(fname):
+    # (width, height, bit depth, colour type, interlace method) from the header of a PNG, or None if it isn't one.
+    with open(fname, "rb") as f:
+        header = f.read(29)
+    if len(header) < 29 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", header[16:24])
+    return width, height, header[24], header[25], header[28]
+
+
+def png_header(fname):
+    # (width, height, mode) if fname is a PNG read_png_strips can decode: non-interlaced, 8 bits per sample.
+    # None for anything else, which callers are expected to load whole instead.
+    ihdr = png_ihdr(fname)
+    if ihdr is None or ihdr[2] != 8 or ihdr[4] != 0 or ihdr[3] not in PNG_MODES:
+        return None
+    return ihdr[0], ihdr[1], PNG_MODES[ihdr[3]]
+
+
+def png_data(f, chunk_size = 1 << 16):
+    # The zlib stream of a PNG, a piece at a time.
+    f.seek(8)
+    while True:
+        length, kind = struct.unpack(">I4s", f.read(8))
+        if kind == b"IEND":
+            return
+        if kind != b"IDAT":
+            f.seek(length + 4, os.SEEK_CUR)
+            continue
+        while length > 0:
+            data = f.read(min(chunk_size, length))
+            length -= len(data)
+            yield data
+        f.seek(4, os.SEEK_CUR)
+
+
+def default_strip_height(width, mode):
+    # About 1MB of decoded rows per strip.
+    return max(1, (1 << 20) // (width * len(mode)))
+
+
+def read_png_strips(fname, strip_height = None):
+    # Yields (y, strip) for a PNG png_header accepts, top to bottom, with strip a PIL image of up to strip_height
+    # full rows carrying the palette and transparency of the file. The image data is inflated a strip at a time,
+    # and each strip is unfiltered by PIL on top of a copy of the row above it, so only one strip is ever decoded.
+    # Stop iterating early and nothing below is read.
+    width, height, mode = png_header(fname)
+    if strip_height is None:
+        strip_height = default_strip_height(width, mode)
+
+    with PIL.Image.open(fname) as image:
+        palette = image.palette if mode == "P" else None
+        transparency = image.info.get("transparency")
+
+    row_bytes = 1 + width * len(mode)
+    inflate = zlib.decompressobj()
+    with open(fname, "rb") as f:
+        data = png_data(f)
+        above = b""
+        for y in range(0, height, strip_height):
+            rows = min(strip_height, height - y)
+            filtered = bytearray(above)
+            while len(filtered) < len(above) + rows * row_bytes:
+                compressed = inflate.unconsumed_tail or next(data, b"")
+                if not compressed:
+                    raise ValueError(f"{fname}: image data ends at row {y}")
+                filtered += inflate.decompress(compressed, len(above) + rows * row_bytes - len(filtered))
+
+            decoded = PIL.Image.frombytes(mode, (width, len(filtered) // row_bytes), zlib.compress(filtered, 0), "zip", mode)
+            above = b"\0" + decoded.crop((0, decoded.height - 1, width, decoded.height)).tobytes()
+            strip = decoded.crop((0, decoded.height - rows, width, decoded.height)) if decoded.height > rows else decoded
+            if palette is not None:
+                strip.putpalette(palette)
+            if transparency is not None:
+                strip.info["transparency"] = transparency
+            yield y, strip